@@ -0,0 +1,148 @@
+"""
+Aggregate triggers
+
+An aggregate trigger fires when a total over the mutations matching its type
+and counterparty conditions crosses a threshold within a rolling window,
+e.g. "card spending in the last 7 days above 200". Next to the conditions of
+the mutation trigger it has the fields:
+- period: the length of the window in days, at most MAX_PERIOD
+- measure: "spent", "received" or "count"
+- threshold_comparator: "above" or "above_equal"
+- threshold_value
+
+The totals are updated incrementally. The window is split in BUCKETS time
+buckets, each holding the amounts spent and received (in cents) and the
+number of mutations, and the running totals of the window are kept next to
+them. A matching event is added to its bucket, and the buckets that left the
+window are subtracted from the totals, so the history is never scanned
+again; the window slides in steps of one bucket. The state is kept in the
+aggregate_state kind per set of trigger fields, so triggers with the same
+fields share it.
+
+A trigger fires once when its condition becomes true, and again only after
+it became false in between. Triggers are evaluated when a matching event is
+received. Only thresholds that the total rises above are offered: a total
+that drops when events leave the window would not be noticed without an
+event, and a falling threshold would fire on the first small event.
+"""
+
+import decimal
+import math
+import operator
+import threading
+
+import predicate
+import storage
+import tenant
+
+# Number of time buckets per window
+BUCKETS = 48
+
+# Maximum length of the window in days
+MAX_PERIOD = 366
+
+# Number of recent event ids kept to ignore events that are processed twice
+RECENT = 50
+
+MEASURES = ["spent", "received", "count"]
+
+_COMPARATORS = {
+    "above": operator.gt,
+    "above_equal": operator.ge,
+}
+
+_LOCK = threading.Lock()
+
+
+def valid(fields):
+    """ Return whether the aggregate fields of a trigger are valid """
+    try:
+        period = float(fields["period"])
+        return math.isfinite(period) and 0 < period <= MAX_PERIOD \
+            and fields["measure"] in MEASURES \
+            and fields["threshold_comparator"] in _COMPARATORS \
+            and float(fields["threshold_value"]) == \
+                float(fields["threshold_value"])
+    except (KeyError, ValueError, TypeError, OverflowError):
+        return False
+
+def cents(amount):
+    """ Return an amount string as an integer number of cents """
+    return int(decimal.Decimal(amount) * 100)
+
+def add_recent(state, eventid):
+    """ Add an event id to the recent ids of a state, returns False if the
+        event was already added """
+    if eventid in state["recent"]:
+        return False
+    state["recent"] = (state["recent"] + [eventid])[-RECENT:]
+    return True
+
+def new_state():
+    """ Return the state of an aggregate without events """
+    return {"buckets": {}, "totals": [0, 0, 0], "latest": 0,
+            "active": False, "recent": []}
+
+def value(state, measure):
+    """ Return the current total of a measure """
+    total = state["totals"][MEASURES.index(measure)]
+    if measure == "count":
+        return total
+    return total / 100
+
+def update(tenantid, fields, item):
+    """ Add a matching event to the totals of an aggregate trigger. Returns
+        the aggregate event if the threshold was crossed, None otherwise. """
+    if not valid(fields):
+        return None
+    key = predicate.fields_hash(fields)
+    kind = tenant.kind("aggregate_state", tenantid)
+    window = int(float(fields["period"]) * 24 * 3600)
+    width = max(window // BUCKETS, 1)
+    timestamp = item["meta"]["timestamp"]
+    with _LOCK:
+        state = storage.get_value(kind, key)
+        if state is None:
+            state = new_state()
+        if not add_recent(state, item["meta"]["id"]):
+            return None
+
+        state["latest"] = max(state["latest"], timestamp)
+        first = (state["latest"] - window) // width + 1
+        bucket = timestamp // width
+        if bucket >= first:
+            amount = cents(item["amount"])
+            add = [max(-amount, 0), max(amount, 0), 1]
+            totals = state["buckets"].setdefault(str(bucket), [0, 0, 0])
+            for num in range(3):
+                totals[num] += add[num]
+                state["totals"][num] += add[num]
+        for name in list(state["buckets"]):
+            if int(name) < first:
+                for num in range(3):
+                    state["totals"][num] -= state["buckets"][name][num]
+                del state["buckets"][name]
+
+        total = value(state, fields["measure"])
+        active = _COMPARATORS[fields["threshold_comparator"]](
+            total, float(fields["threshold_value"]))
+        fired = active and not state["active"]
+        state["active"] = active
+        storage.store_large(kind, key, state)
+
+    if not fired:
+        return None
+    result = dict(item)
+    result.update({
+        "period": fields["period"],
+        "measure": fields["measure"],
+        "total": str(total) if fields["measure"] == "count"
+                 else "{:.2f}".format(total),
+        "count": state["totals"][2],
+        "meta": {
+            "id": "{}_{}".format(item["meta"]["id"], key[:12]),
+            "timestamp": timestamp
+        }
+    })
+    return result
+
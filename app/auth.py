@@ -4,7 +4,7 @@ Handles various authentications for the app:
 - OAuth flow / API key submission for bunq
 - IFTTT service key submission
 """
-# pylint: disable=broad-except
+# pylint: disable=broad-except,import-outside-toplevel
 
 import base64
 import hashlib
@@ -13,13 +13,16 @@ import secrets
 import time
 import traceback
 
-import requests
 from flask import request, render_template, make_response, redirect
 
 import bunq
+import log
 import storage
+import tenant
 import util
 
+LOG = log.get_logger("auth")
+
 
 def user_login():
     """ Handles password login """
@@ -65,11 +68,22 @@ def set_ifttt_service_key():
     try:
         key = request.form["iftttkey"]
         if len(key) != 64:
-            print("Invalid key: ", key)
+            LOG.warning("[auth] invalid IFTTT service key (length %d)",
+                        len(key))
             return render_template("message.html", msgtype="danger", msg=\
                 'Invalid key! <br><br>'\
                 '<a href="/">Click here to try again</a>')
-        util.save_ifttt_service_key(key)
+        tenantid = request.form.get("tenant") or None
+        if tenantid is not None and tenantid not in tenant.get_tenants():
+            return render_template("message.html", msgtype="danger", msg=\
+                'Unknown bunq user! <br><br>'\
+                '<a href="/">Click here to try again</a>')
+        valid, keytenant = util.ifttt_key_tenant(key)
+        if valid and keytenant != tenantid:
+            return render_template("message.html", msgtype="danger", msg=\
+                'This key is already used for another bunq user! <br><br>'\
+                '<a href="/">Click here to try again</a>')
+        util.save_ifttt_service_key(key, tenantid)
         return render_template("message.html", msgtype="success", msg=\
             'IFTTT service key successfully set <br><br>'\
             '<a href="/">Click here to return home</a>')
@@ -87,7 +101,7 @@ def set_bunq_oauth_response():
 
         code = request.args["code"]
         if len(code) != 64:
-            print("Invalid code: ", code)
+            LOG.warning("[auth] invalid OAuth code (length %d)", len(code))
             return render_template("message.html", msgtype="danger", msg=\
                 'Invalid code! <br><br>'\
                 '<a href="/">Click here to try again</a>')
@@ -97,17 +111,25 @@ def set_bunq_oauth_response():
               "&client_id={}&client_secret={}"\
               .format(code, request.url_root + "auth",
                       oauthdata["client_id"], oauthdata["client_secret"])
+        import requests
         req = requests.post(url)
         key = req.json()["access_token"]
 
         oauthdata["timestamp"] = int(time.time())
         oauthdata["triggers"] = []
-        storage.store_large("bunq2IFTTT", "bunq_oauth", oauthdata)
+        additional = oauthdata.get("additional", False)
+        if not additional:
+            storage.store_large("bunq2IFTTT", tenant.oauth_index(), oauthdata)
 
         config = bunq.install(key, allips=oauthdata["allips"],
-                              urlroot=request.url_root, mode="OAuth")
+                              urlroot=request.url_root, mode="OAuth",
+                              additional=additional)
         util.sync_permissions(config)
         bunq.save_config(config)
+        if additional:
+            storage.store_large("bunq2IFTTT",
+                                tenant.oauth_index(config["tenant"]),
+                                oauthdata)
 
         return render_template("message.html", msgtype="success", msg=\
             'OAuth successfully setup <br><br>'\
@@ -125,6 +147,10 @@ def set_bunq_oauth_api_key():
         allips = False
         if "allips" in request.form and request.form["allips"] == 'on':
             allips = True
+        additional = False
+        if "additional" in request.form and \
+                request.form["additional"] == 'on':
+            additional = True
 
         key = request.form["bunqkey"]
         tokens = re.split("[:, \r\n\t]+", key.strip())
@@ -135,6 +161,7 @@ def set_bunq_oauth_api_key():
                 "client_id": tokens[2],
                 "client_secret": tokens[5],
                 "allips": allips,
+                "additional": additional,
             }
             storage.store_large("bunq2IFTTT", "bunq_oauth_new", oauthdata)
             redirect_url = request.url_root + "auth"
@@ -150,7 +177,8 @@ def set_bunq_oauth_api_key():
             # API key submitted
             try:
                 config = bunq.install(key, allips=allips,
-                                      urlroot=request.url_root, mode="APIkey")
+                                      urlroot=request.url_root, mode="APIkey",
+                                      additional=additional)
                 util.sync_permissions(config)
                 bunq.save_config(config)
                 return render_template("message.html", msgtype="success", msg=\
@@ -162,7 +190,8 @@ def set_bunq_oauth_api_key():
                     'An exception occurred while installing the API key. '\
                     'See the logs. <br><br>'\
                     '<a href="/">Click here to try again</a>')
-        print("Invalid key: ", key)
+        LOG.warning("[auth] no valid API key or OAuth client id/secret "
+                    "(%d tokens)", len(tokens))
         return render_template("message.html", msgtype="danger", msg=\
             'No valid API key or OAuth client id/secret found!<br><br>'\
             '<a href="/">Click here to return home</a>')
@@ -172,9 +201,10 @@ def set_bunq_oauth_api_key():
             'An unknown exception occurred. See the logs. <br><br>'\
             '<a href="/">Click here to return home</a>')
 
-def bunq_oauth_reauthorize():
-    """ Reauthorize OAuth using the same client id/secret """
-    oauthdata = storage.get_value("bunq2IFTTT", "bunq_oauth")
+def bunq_oauth_reauthorize(tenantid=None):
+    """ Reauthorize OAuth of a tenant using the same client id/secret """
+    oauthdata = storage.get_value("bunq2IFTTT", tenant.oauth_index(tenantid))
+    oauthdata["additional"] = tenantid is not None
     storage.store_large("bunq2IFTTT", "bunq_oauth_new", oauthdata)
     redirect_url = request.url_root + "auth"
     url = "https://oauth.bunq.com/auth?response_type=code"\
@@ -0,0 +1,98 @@
+"""
+Backfill of new mutation triggers
+
+A new trigger would have an empty history until the next bunq callback.
+When a mutation trigger is first stored, a background thread lists the
+recent payments of its account(s) from bunq, newest first, following the
+pagination of the payment list for at most MAX_PAGES pages per account.
+The payments are translated and matched like callbacks, and the matching
+ones are added to the history of the trigger. IFTTT is then notified, so it
+polls again and picks up the history.
+
+The backfill stops early at payments older than the retention of the
+history, or once the history is full.
+"""
+# pylint: disable=broad-except,import-outside-toplevel
+
+import threading
+import time
+
+import bunq
+import history
+import log
+import multimatch
+import notify
+import predicate
+import storage
+import tenant
+import util
+
+LOG = log.get_logger("backfill")
+
+# Number of payments per page and maximum number of pages per account
+PAGE_SIZE = 200
+MAX_PAGES = 5
+
+_RUNNING = set()
+_LOCK = threading.Lock()
+
+
+def start(tenantid, identity, fields):
+    """ Start the backfill of a new mutation trigger in the background """
+    if MAX_PAGES <= 0:
+        return
+    with _LOCK:
+        if (tenantid, identity) in _RUNNING:
+            return
+        _RUNNING.add((tenantid, identity))
+    threading.Thread(target=run, args=(tenantid, identity, fields),
+                     daemon=True, name="backfill").start()
+
+def run(tenantid, identity, fields):
+    """ Add the matching recent payments to the history of a trigger """
+    import event
+    matched = 0
+    try:
+        config = bunq.retrieve_config(tenantid=tenantid)
+        pred = predicate.get_predicate(fields)
+        eventkind = tenant.kind("event_mutation", tenantid)
+        retention = history.RETENTION["mutation"]
+        cutoff = time.time() - retention["days"] * 24 * 3600
+        for acc in util.get_bunq_accounts("Mutation", config):
+            if fields["account"] not in ["ANY", acc["iban"]]:
+                continue
+            for payment in payments(config, acc):
+                item = event.mutation_item(payment, acc["description"])
+                if item["meta"]["timestamp"] < cutoff:
+                    break
+                if not pred.matches(item, multimatch.scan(item)):
+                    continue
+                storage.store_large(eventkind, item["meta"]["id"], item,
+                                    item["meta"]["timestamp"])
+                history.add("mutation", tenantid, identity, item)
+                matched += 1
+                if matched >= retention["events"]:
+                    break
+    except Exception:
+        LOG.exception("[backfill] cannot backfill trigger %s", identity)
+    finally:
+        with _LOCK:
+            _RUNNING.discard((tenantid, identity))
+    LOG.info("[backfill] %d events for trigger %s", matched, identity)
+    if matched:
+        notify.send([identity], tenantid)
+
+def payments(config, acc):
+    """ Yield the payments of an account, newest first, up to MAX_PAGES
+        pages """
+    endpoint = "v1/user/{}/monetary-account/{}/payment?count={}"\
+               .format(config["user_id"], acc["id"], PAGE_SIZE)
+    for _ in range(MAX_PAGES):
+        result = bunq.get(endpoint, config)
+        for res in result["Response"]:
+            if "Payment" in res:
+                yield res["Payment"]
+        pagination = result.get("Pagination") or {}
+        if not pagination.get("older_url"):
+            return
+        endpoint = pagination["older_url"].lstrip("/")
@@ -5,27 +5,28 @@ Features:
 - Optimized for use in Google AppEngine
 - Uses the Google Cloud Datastore for credentials (no files are used)
 - Implements in-memory caching of credentials for optimal performance
-
-Caveat: for use with one API key only per installation. This module does not
-handle multiple API keys!
+- Supports multiple API keys (tenants), each with their own credentials,
+  connection pool and rate limit budget (see the tenant module)
 """
-# pylint: disable=dangerous-default-value
+# pylint: disable=dangerous-default-value,import-outside-toplevel
+#
+# The requests and cryptography packages are imported when first used, as
+# importing them at module load time adds noticeably to the cold start time.
 
 import base64
+import functools
 import json
 import re
 import secrets
-import traceback
-
-import requests
-
-from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes, hmac, serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import threading
+import time
+from collections import deque
 
+import log
 import storage
+import tenant
+
+LOG = log.get_logger("bunq")
 
 NAME = "bunq2IFTTT"
 
@@ -53,11 +54,16 @@ def delete(endpoint, config={}):
 # Handle installation / registration of the API key
 #---------------------------------------------------
 
-def install(token, name=NAME, allips=False, urlroot=None, mode=None):
-    """ Handles the installation and registration of the API key """
+def install(token, name=NAME, allips=False, urlroot=None, mode=None,
+            additional=False):
+    """ Handles the installation and registration of the API key
+
+        When additional is set, the key is installed as an additional tenant
+        next to the default one, keyed by its bunq user id """
     try:
         oldconfig = {}
-        retrieve_config(oldconfig)
+        if not additional:
+            retrieve_config(oldconfig)
 
         config = {"access_token": token, "mode": mode}
         if "permissions" in oldconfig:
@@ -69,8 +75,16 @@ def install(token, name=NAME, allips=False, urlroot=None, mode=None):
 
         register_token(config, name, allips)
         retrieve_userid(config)
+        if additional:
+            config["tenant"] = str(config["user_id"])
+            retrieve_config(oldconfig, config["tenant"])
+            if "permissions" in oldconfig:
+                config["permissions"] = oldconfig["permissions"]
         retrieve_accounts(config)
         save_config(config)
+        if additional:
+            tenant.register(config["tenant"],
+                             [acc["iban"] for acc in config["accounts"]])
 
         if urlroot is not None:
             register_callback(config, urlroot)
@@ -83,13 +97,16 @@ def install(token, name=NAME, allips=False, urlroot=None, mode=None):
         return config
 
     except:
-        traceback.print_exc()
+        LOG.exception("[bunq] installation failed")
         raise
 
 
 def generate_key(config):
     """ Generate a private/public keypair to communicate with the bunq API """
-    print("[bunq] Generating new private key...")
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    LOG.info("[bunq] Generating new private key...")
     my_private_key = rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048,
@@ -115,7 +132,7 @@ def generate_key(config):
 
 def install_key(config):
     """ Install the generated private/public keypair with bunq """
-    print("[bunq] Installing key...")
+    LOG.info("[bunq] Installing key...")
     data = {"client_public_key": config["public_key_enc"]}
     result = post("v1/installation", data, config)
 
@@ -124,13 +141,13 @@ def install_key(config):
 
     config["install_token"] = install_token
     config["server_key_enc"] = srv_key
-    config["server_key"] = serialization.load_pem_public_key(
-        srv_key.encode("ascii"), backend=default_backend())
+    config["server_key"] = load_public_key(srv_key)
 
 
 def register_token(config, name, allips):
     """ Register the provided access token with bunq """
-    print("[bunq] Registering token...")
+    import requests
+    LOG.info("[bunq] Registering token...")
     if allips:
         ips = ["*"]
     else:
@@ -143,7 +160,7 @@ def register_token(config, name, allips):
 
 def retrieve_userid(config):
     """ Retrieve the userid that needs to be used in api calls """
-    print("[bunq] Retrieving userid...")
+    LOG.info("[bunq] Retrieving userid...")
     result = get("v1/user", config)
     for user in result["Response"]:
         for typ in user:
@@ -159,7 +176,7 @@ _TYPE_TRANSLATION = {
 
 def retrieve_accounts(config):
     """ Retrieve the set of accounts of the user """
-    print("[bunq] Retrieving accounts...")
+    LOG.info("[bunq] Retrieving accounts...")
     config["accounts"] = []
     result = get("v1/user/{}/monetary-account".format(config["user_id"]),
                  config)
@@ -182,7 +199,7 @@ def retrieve_accounts(config):
 
 def retrieve_account_balances(config):
     """ Retrieve the balances of accounts of the user """
-    print("[bunq] Retrieving account balances...")
+    LOG.info("[bunq] Retrieving account balances...")
     result = get("v1/user/{}/monetary-account".format(config["user_id"]),
                  config)
     response = {}
@@ -201,7 +218,7 @@ def retrieve_account_balances(config):
 
 def register_callback(config, urlroot):
     """ Register the callbacks on the account """
-    print("[bunq] Set notification filters...")
+    LOG.info("[bunq] Set notification filters...")
     post("v1/user/{}/notification-filter-url".format(config["user_id"]), {
         "notification_filters": [{
             "category": "MUTATION",
@@ -215,7 +232,7 @@ def register_callback(config, urlroot):
 
 def unregister_callback(config):
     """ Remove old callbacks when reauthorizing """
-    print("[bunq] Removing old notification filters...")
+    LOG.info("[bunq] Removing old notification filters...")
     old = get("v1/user/{}/notification-filter-url".format(config["user_id"]),
               config)
     new = {"notification_filters": []}
@@ -224,8 +241,8 @@ def unregister_callback(config):
             if not noti["notification_target"].endswith("bunq2ifttt_mutation")\
             and not noti["notification_target"].endswith("bunq2ifttt_request"):
                 new["notification_filters"].append(noti)
-    print("old: "+json.dumps(old))
-    print("new: "+json.dumps(new))
+    LOG.info("[bunq] old notification filters: %s", log.Json(old))
+    LOG.info("[bunq] new notification filters: %s", log.Json(new))
     post("v1/user/{}/notification-filter-url".format(config["user_id"]),
          new, config)
 
@@ -241,36 +258,50 @@ def save_config(config):
         if isinstance(config[key], (str, int, float, dict, list))\
         or config[key] is None:
             tosave[key] = config[key]
-    storage.store_large("bunq2IFTTT", "bunq_config", tosave)
+    storage.store_large("bunq2IFTTT",
+                        tenant.config_index(config.get("tenant")), tosave)
 
-def retrieve_config(config={}):
+def retrieve_config(config=None, tenantid=None):
     """ Retrieve the configuration parameters from storage """
+    if config is None:
+        config = {}
     for key in list(config.keys()):
         del config[key]
-    toload = storage.get_value("bunq2IFTTT", "bunq_config")
+    toload = storage.get_value("bunq2IFTTT", tenant.config_index(tenantid))
     if toload is not None:
         for key in toload:
             config[key] = toload[key]
     # Convert strings back to keys
     if "server_key_enc" in config:
-        config["server_key"] = serialization.load_pem_public_key(
-            config["server_key_enc"].encode("ascii"),
-            backend=default_backend())
+        config["server_key"] = load_public_key(config["server_key_enc"])
     if "public_key_enc" in config:
-        config["public_key"] = serialization.load_pem_public_key(
-            config["public_key_enc"].encode("ascii"),
-            backend=default_backend())
+        config["public_key"] = load_public_key(config["public_key_enc"])
     if "private_key_enc" in config:
-        config["private_key"] = serialization.load_pem_private_key(
-            config["private_key_enc"].encode("ascii"),
-            password=None, backend=default_backend())
+        config["private_key"] = load_private_key(config["private_key_enc"])
     return config
 
+@functools.lru_cache(maxsize=32)
+def load_public_key(pem):
+    """ Parse a PEM encoded public key, cached as parsing is expensive """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    return serialization.load_pem_public_key(pem.encode("ascii"),
+                                             backend=default_backend())
+
+@functools.lru_cache(maxsize=32)
+def load_private_key(pem):
+    """ Parse a PEM encoded private key, cached as parsing is expensive """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    return serialization.load_pem_private_key(pem.encode("ascii"),
+                                              password=None,
+                                              backend=default_backend())
+
 
 def get_session_token(config):
     """ Return the session token, create or retrieve from storage if needed """
     if "private_key" not in config:
-        retrieve_config(config)
+        retrieve_config(config, config.get("tenant"))
     if "session_token" not in config:
         refresh_session_token(config)
     return config["session_token"]
@@ -278,31 +309,31 @@ def get_session_token(config):
 def get_access_token(config):
     """ Return the access token, retrieve from storage if needed """
     if "access_token" not in config:
-        retrieve_config(config)
+        retrieve_config(config, config.get("tenant"))
     return config["access_token"]
 
 def get_install_token(config):
     """ Return the install token, retrieve from storage if needed """
     if "install_token" not in config:
-        retrieve_config(config)
+        retrieve_config(config, config.get("tenant"))
     return config["install_token"]
 
 def get_server_key(config):
     """ Return the server public key, retrieve from storage if needed """
     if "server_key" not in config:
-        retrieve_config(config)
+        retrieve_config(config, config.get("tenant"))
     return config["server_key"]
 
 def get_private_key(config):
     """ Return the my private key, retrieve from storage if needed """
     if "private_key" not in config:
-        retrieve_config(config)
+        retrieve_config(config, config.get("tenant"))
     return config["private_key"]
 
 def get_public_key(config):
     """ Return the my public key, retrieve from storage if needed """
     if "public_key" not in config:
-        retrieve_config(config)
+        retrieve_config(config, config.get("tenant"))
     return config["public_key"]
 
 
@@ -321,7 +352,7 @@ def session_request(method, endpoint, config, data=None, extra_headers=None):
 
 def refresh_session_token(config):
     """ Refresh an expired session token """
-    print("[bunq] Refreshing session token...")
+    LOG.info("[bunq] Refreshing session token...")
     data = {"secret": get_access_token(config)}
     result = post("v1/session-server", data, config)
     if "Response" in result:
@@ -329,12 +360,16 @@ def refresh_session_token(config):
         config["session_token"] = session_token
         save_config(config)
         return session_token
-    print("ERROR: session token refresh failed!")
-    print(result)
+    LOG.error("[bunq] session token refresh failed: %s", log.Json(result))
     return ""
 
 def session_request_encrypted(method, endpoint, data, config={}):
     """ Send an encrypted request to the bunq API """
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, hmac
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, \
+                                                       modes
     data = json.dumps(data).encode("utf-8")
     padding_length = (16 - len(data) % 16)
     padding_character = bytes(bytearray([padding_length]))
@@ -365,9 +400,52 @@ def session_request_encrypted(method, endpoint, data, config={}):
 
 BUNQAPI = "https://api.bunq.com/"
 
+# Rate limits imposed by bunq: (number of calls, per number of seconds)
+RATE_LIMITS = {
+    "GET": (3, 3),
+    "POST": (5, 3),
+    "PUT": (2, 3),
+    "DELETE": (2, 3),
+}
+
+# Per tenant connection pools and rate limit budgets
+_SESSIONS = {}
+_BUDGETS = {}
+_POOL_LOCK = threading.Lock()
+
+def get_session(tenantid):
+    """ Return the HTTP session (connection pool) for the given tenant """
+    import requests
+    with _POOL_LOCK:
+        if tenantid not in _SESSIONS:
+            _SESSIONS[tenantid] = requests.Session()
+        return _SESSIONS[tenantid]
+
+def warmup_session(tenantid):
+    """ Open a connection to the bunq API in the pool of the given tenant """
+    try:
+        get_session(tenantid).head(BUNQAPI, timeout=5)
+    except Exception: # pylint: disable=broad-except
+        LOG.exception("[bunq] cannot open connection")
+
+def throttle(tenantid, method):
+    """ Wait until the rate limit budget of the tenant allows the call """
+    calls, period = RATE_LIMITS[method]
+    while True:
+        with _POOL_LOCK:
+            budget = _BUDGETS.setdefault((tenantid, method), deque())
+            now = time.time()
+            while budget and budget[0] <= now - period:
+                budget.popleft()
+            if len(budget) < calls:
+                budget.append(now)
+                return
+            wait = budget[0] + period - now
+        time.sleep(wait)
+
 def request(method, endpoint, config, data=None, extra_headers=None):
     """ This method executes the actual request to the bunq API """
-    print(method, endpoint)
+    LOG.debug("[bunq] %s %s", method, endpoint)
     if data is None:
         data = ""
     elif not isinstance(data, bytes):
@@ -384,17 +462,20 @@ def request(method, endpoint, config, data=None, extra_headers=None):
     elif endpoint != "v1/installation":
         headers['X-Bunq-Client-Authentication'] = get_session_token(config)
     sign(endpoint, config, headers, data)
+    tenantid = config.get("tenant")
+    session = get_session(tenantid)
+    throttle(tenantid, method)
     if method == "GET":
-        reply = requests.get(BUNQAPI + endpoint, headers=headers)
+        reply = session.get(BUNQAPI + endpoint, headers=headers)
     elif method == "POST":
-        reply = requests.post(BUNQAPI + endpoint, headers=headers, data=data)
+        reply = session.post(BUNQAPI + endpoint, headers=headers, data=data)
     elif method == "PUT":
-        reply = requests.put(BUNQAPI + endpoint, headers=headers, data=data)
+        reply = session.put(BUNQAPI + endpoint, headers=headers, data=data)
     elif method == "DELETE":
-        reply = requests.delete(BUNQAPI + endpoint, headers=headers)
+        reply = session.delete(BUNQAPI + endpoint, headers=headers)
     if reply.status_code == 500 and re.match(r"v1/user/\d+/card/\d+",
                                              endpoint):
-        print("Ignoring error 500 for card update")
+        LOG.info("[bunq] ignoring error 500 for card update")
         return "OK" # work around a bug where the bunq API returns status 500
                     # on a card account update, even though the call succeeded
     verify(endpoint, config, reply.status_code, reply.headers, reply.text)
@@ -406,6 +487,8 @@ def sign(endpoint, config, headers, data):
     """ Sign the message before sending """
     if endpoint == "v1/installation":
         return # Installation call is not signed
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
     message = data.encode("ascii")
     key = get_private_key(config)
     sig = key.sign(message, padding.PKCS1v15(), hashes.SHA256())
@@ -419,9 +502,13 @@ def verify(endpoint, config, status_code, headers, text):
     if headers["Content-Type"] == "application/json":
         result = json.loads(text)
         if "Error" in result:
-            print(result)
+            LOG.warning("[bunq] error reply: %s", log.Json(result))
             return # Errors are not signed
 
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
     sig = base64.b64decode(headers["X-Bunq-Server-Signature"])
     key = get_server_key(config)
     try: # try new body signing first
@@ -429,7 +516,7 @@ def verify(endpoint, config, status_code, headers, text):
                    padding.PKCS1v15(), hashes.SHA256())
 
     except InvalidSignature: # fall back to old signing
-        print("Fallback to old signature verification method")
+        LOG.info("[bunq] fallback to old signature verification method")
         message = str(status_code) + "\n"
         for name in sorted(headers.keys()):
             if name[:7] == "X-Bunq-" and name != "X-Bunq-Server-Signature":
@@ -439,4 +526,4 @@ def verify(endpoint, config, status_code, headers, text):
             key.verify(sig, message.encode("ascii"),
                        padding.PKCS1v15(), hashes.SHA256())
         except InvalidSignature:
-            print("WARNING: signature verification failed!")
+            LOG.warning("[bunq] signature verification failed!")
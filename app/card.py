@@ -11,19 +11,23 @@ from flask import request
 
 import util
 import bunq
+import log
+
+LOG = log.get_logger("card")
 
 
 def get_bunq_cards():
-    """ Return the list of bunq cards """
-    config = bunq.retrieve_config()
-    data = bunq.get("v1/user/{}/card".format(config["user_id"]), config)
+    """ Return the list of bunq cards of the tenant of the IFTTT request """
     results = []
+    config = util.get_ifttt_config()
+    if "user_id" not in config:
+        return results
+    data = bunq.get("v1/user/{}/card".format(config["user_id"]), config)
     for item in data["Response"]:
         for typ in item:
             card = item[typ]
             if card["status"] == "ACTIVE":
                 if card["type"] != "MASTERCARD_VIRTUAL":
-                    print(card)
                     results.append({
                         "label": card["second_line"],
                         "value": str(card["id"])
@@ -34,7 +38,7 @@ def get_bunq_cards():
 def change_card_account():
     """ Execute a change card account action """
     data = request.get_json()
-    print("[change_card_account] input: {}".format(json.dumps(data)))
+    log.payload(LOG, "[change_card_account] input", data)
 
     errmsg = None
     if "actionFields" not in data:
@@ -47,7 +51,7 @@ def change_card_account():
                 errmsg = "missing field: "+field
 
     if errmsg:
-        print("[change_card_account] ERROR: "+errmsg)
+        LOG.error("[change_card_account] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -57,13 +61,14 @@ def change_card_account():
     if fields["account"] == "NL42BUNQ0123456789":
         return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
 
+    config = util.get_ifttt_config()
     accountid = None
-    for acc in util.get_bunq_accounts("Card"):
+    for acc in util.get_bunq_accounts("Card", config):
         if acc["iban"] == fields["account"]:
             accountid = acc["id"]
     if accountid is None:
         errmsg = "unknown account: "+fields["account"]
-        print("[change_card_account] ERROR: "+errmsg)
+        LOG.error("[change_card_account] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -77,7 +82,6 @@ def change_card_account():
         "monetary_account_id": int(accountid),
     }]}
 
-    config = bunq.retrieve_config()
     data = bunq.get("v1/user/{}/card".format(config["user_id"]), config)
     for item in data["Response"]:
         for typ in item:
@@ -93,7 +97,7 @@ def change_card_account():
     res = bunq.session_request_encrypted("PUT", "v1/user/{}/card/{}".format(
         config["user_id"], fields["card"]), msg, config)
     if "Error" in res:
-        print(json.dumps(res))
+        LOG.error("[change_card_account] bunq error: %s", log.Json(res))
         errmsg = "Bunq API call failed, see the logs!"
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
@@ -0,0 +1,142 @@
+"""
+Cleanup of unused triggers
+
+IFTTT does not reliably tell us when an applet is disconnected, so triggers
+could stay around forever, with their histories and state, and keep showing
+up in every query on the triggers of an account. Polls record the day a
+trigger was last polled in its polled property, written at most once a day
+per instance. A daily cron job removes the triggers that were not polled for
+MAX_AGE days, at most BATCH per run, together with:
+- their history records and the old style <identity>_t history record
+- their poll cache entries
+- their entries in the balance state, or the aggregate state no longer used
+  by any trigger
+
+Triggers stored before the polled property existed are stamped with the
+current day when the job first sees them, and <identity>_t records without a
+trigger are removed at the same time.
+
+The same job removes the events in the event store older than the longest
+history retention of the trigger types they feed, as no history can still
+reference them.
+"""
+
+import threading
+import time
+
+import history
+import pollcache
+import predicate
+import storage
+import tenant
+import triggerindex
+
+# Days without a poll after which a trigger is removed
+MAX_AGE = 30
+
+# Maximum number of triggers removed per run
+BATCH = 500
+
+_TOUCHED = {"day": None, "triggers": set()}
+_LOCK = threading.Lock()
+
+
+def today():
+    """ Return the current day number """
+    return int(time.time() // (24 * 3600))
+
+def touch(kind, identity):
+    """ Record that a trigger was polled today """
+    day = today()
+    with _LOCK:
+        if _TOUCHED["day"] != day:
+            _TOUCHED["day"] = day
+            _TOUCHED["triggers"] = set()
+        if (kind, identity) in _TOUCHED["triggers"]:
+            return
+        _TOUCHED["triggers"].add((kind, identity))
+    entity = storage.retrieve(kind, identity)
+    if entity is not None and entity.get("polled") != day:
+        entity["polled"] = day
+        storage.store(kind, identity, entity)
+
+def run():
+    """ Remove the triggers that were not polled recently, returns the number
+        of triggers removed """
+    import event
+    removed = 0
+    for tenantid in tenant.all_tenants():
+        purge(event.TRIGGER_TYPES, tenantid)
+        for triggertype in event.TRIGGER_TYPES:
+            if removed >= BATCH:
+                return removed
+            stamp(triggertype, tenantid)
+            kind = tenant.kind("trigger_" + triggertype, tenantid)
+            stale = storage.query(kind, "polled", "<", today() - MAX_AGE)
+            identities = [entity["identity"]
+                          for entity in stale[:BATCH - removed]]
+            if identities:
+                remove(triggertype, tenantid, identities)
+                removed += len(identities)
+    return removed
+
+def purge(triggertypes, tenantid):
+    """ Remove the events older than the retention of the trigger types
+        they feed """
+    days = {}
+    for triggertype, spec in triggertypes.items():
+        days[spec["events"]] = max(days.get(spec["events"], 0),
+                                   history.RETENTION[triggertype]["days"])
+    for eventtype, maxdays in days.items():
+        storage.remove_older(tenant.kind("event_" + eventtype, tenantid),
+                             time.time() - maxdays * 24 * 3600)
+
+def stamp(triggertype, tenantid):
+    """ Stamp the triggers without polled property with the current day,
+        and remove old style histories without trigger, once per kind """
+    statekind = tenant.kind("cleanup", tenantid)
+    stamped = storage.get_value("bunq2IFTTT", statekind)
+    if stamped is None:
+        stamped = []
+    if triggertype in stamped:
+        return
+    kind = tenant.kind("trigger_" + triggertype, tenantid)
+    entities = storage.query_all(kind)
+    identities = set([entity["identity"] for entity in entities
+                      if "identity" in entity])
+    for entity in entities:
+        if "identity" in entity and "polled" not in entity:
+            storage.store(kind, entity["id"], dict(
+                [(key, value) for key, value in entity.items() if key != "id"],
+                polled=today()))
+    storage.remove_multi(kind, [entity["id"] for entity in entities
+                                if entity["id"].endswith("_t")
+                                and entity["id"][:-2] not in identities])
+    storage.store_large("bunq2IFTTT", statekind, stamped + [triggertype])
+
+def remove(triggertype, tenantid, identities):
+    """ Remove triggers with their histories and state """
+    kind = tenant.kind("trigger_" + triggertype, tenantid)
+    for identity in identities:
+        pollcache.invalidate(kind, identity)
+        history.remove_all(triggertype, tenantid, identity)
+    storage.remove_multi(kind, identities + [identity + "_t"
+                                             for identity in identities])
+    triggerindex.changed("trigger_" + triggertype, tenantid)
+
+    if triggertype == "balance":
+        statekind = tenant.kind("balance_state", tenantid)
+        for entity in storage.query_all(statekind):
+            state = entity["value"]
+            if any([identity in state for identity in identities]):
+                for identity in identities:
+                    state.pop(identity, None)
+                storage.store_large(statekind, entity["id"], state)
+    elif triggertype == "aggregate":
+        used = set([predicate.fields_hash(entity["fields"])
+                    for entity in storage.query_all(kind)
+                    if "fields" in entity])
+        statekind = tenant.kind("aggregate_state", tenantid)
+        storage.remove_multi(statekind, [
+            name for name in storage.query_indexes(statekind)
+            if name not in used])
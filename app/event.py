@@ -4,190 +4,433 @@ Events
 Handles all events:
 - callbacks from bunq
 - ifttt triggers on the events received from bunq
+
+The trigger types are declared in the registry at the end of this module:
+the events they are matched against, which matches go into their history
+and how their fields are checked. One engine handles all of them: matching
+events against the trigger index, adding to the histories, and serving
+polls from the histories. A new trigger type only needs a registry entry
+(and its routes follow from it in main).
 """
 # pylint: disable=broad-except
 
 import json
 import time
-import traceback
-import uuid
-
-import arrow
-import requests
 
 from flask import request
 
+import aggregate
+import backfill
+import bunq
+import cleanup
+import history
+import ingest
+import log
+import multimatch
+import notify
+import pollcache
+import predicate
+import rollup
 import storage
+import tenant
+import timeutil
+import triggerindex
 import util
 
+LOG = log.get_logger("event")
+
 
 ###############################################################################
 # Callback methods called by bunq
 ###############################################################################
 
 def bunq_callback_request():
-    """ Handle bunq callbacks of type REQUEST """
+    """ Handle bunq callbacks of type REQUEST, queued for processing """
     try:
         data = request.get_json()
-        print("[bunqcb_request] input: {}".format(json.dumps(data)))
         if data["NotificationUrl"]["event_type"] != "REQUEST_RESPONSE_CREATED":
-            print("[bunqcb_request] ignoring {} event"
-                  .format(data["NotificationUrl"]["event_type"]))
+            LOG.info("[bunqcb_request] ignoring %s event",
+                     data["NotificationUrl"]["event_type"])
             return 200
-
         obj = data["NotificationUrl"]["object"]["RequestResponse"]
+        if obj["id"] is None or obj["alias"]["iban"] is None:
+            raise ValueError("missing id or iban")
+    except Exception:
+        LOG.exception("[bunqcb_request] invalid bunq callback")
+        return 400
+    try:
+        ingest.enqueue("request", data)
+    except Exception:
+        LOG.exception("[bunqcb_request] queueing bunq callback")
+        return 500
+    return 200
+
+def process_request(data, retry=False):
+    """ Process a queued bunq callback of type REQUEST """
+    return process("request", data, retry)
+
+def bunq_callback_mutation():
+    """ Handle bunq callbacks of type MUTATION, queued for processing """
+    try:
+        data = request.get_json()
+        payment = data["NotificationUrl"]["object"]["Payment"]
+        if payment["id"] is None or payment["alias"]["iban"] is None:
+            raise ValueError("missing id or iban")
+    except Exception:
+        LOG.exception("[bunqcb_mutation] invalid bunq callback")
+        return 400
+    try:
+        ingest.enqueue("mutation", data)
+    except Exception:
+        LOG.exception("[bunqcb_mutation] queueing bunq callback")
+        return 500
+    return 200
+
+def process_mutation(data, retry=False):
+    """ Process a queued bunq callback of type MUTATION """
+    return process("mutation", data, retry)
+
+def process(eventtype, data, retry=False):
+    """ Translate a queued bunq callback to an event, store it and match it
+        against the triggers """
+    source = SOURCES[eventtype]
+    label = "[bunqcb_{}]".format(eventtype)
+    try:
+        log.payload(LOG, label + " input", data)
+        obj = data["NotificationUrl"]["object"][source["object"]]
         metaid = obj["id"]
-        if storage.seen("seen_request", metaid):
-            print("[bunqcb_request] duplicate transaction")
+        if not retry and storage.seen("seen_" + eventtype, metaid):
+            LOG.info("%s duplicate transaction", label)
             return 200
 
         iban = obj["alias"]["iban"]
-        valid, accname = util.check_valid_bunq_account(iban, "Request")
+        tenantid = tenant.for_callback(obj)
+        config = bunq.retrieve_config(tenantid=tenantid)
+        valid, accname = util.check_valid_bunq_account(
+            iban, source["permission"], config)
         if not valid:
-            print("[bunqcb_request] trigger not enabled for this account")
+            LOG.info("%s trigger not enabled for this account", label)
             return 200
 
-        item = {
-            "created_at": obj["created"],
-            "date": arrow.get(obj["created"]).format("YYYY-MM-DD"),
-            "amount": obj["amount_inquired"]["value"],
-            "account": iban,
-            "account_name": accname,
-            "counterparty_account": counterparty_account(obj),
-            "counterparty_name": obj["counterparty_alias"]["display_name"],
-            "description": obj["description"],
-            "request_id": metaid,
-            "meta": {
-                "id": metaid,
-                "timestamp": arrow.get(obj["created"]).timestamp
-            }
-        }
-
-        print("[bunqcb_request] translated: {}".format(json.dumps(item)))
-
-        triggerids = []
-        for account in ["ANY", iban]:
-            for trigger in storage.query("trigger_request",
-                                         "account", "=", account):
-                ident = trigger["identity"]
-                if check_fields("request", ident, item, trigger["fields"]):
-                    triggerids.append(ident)
-                    storage.insert_value_maxsize("trigger_request",
-                                                 ident+"_t", item, 50)
-        print("[bunqcb_request] Matched triggers:", json.dumps(triggerids))
-        if triggerids:
-            data = {"data": []}
-            for triggerid in triggerids:
-                data["data"].append({"trigger_identity": triggerid})
-            headers = {
-                "IFTTT-Channel-Key": util.get_ifttt_service_key(),
-                "IFTTT-Service-Key": util.get_ifttt_service_key(),
-                "X-Request-ID": uuid.uuid4().hex,
-                "Content-Type": "application/json"
-            }
-            print("[bunqcb_request] to ifttt: {}".format(json.dumps(data)))
-            res = requests.post("https://realtime.ifttt.com/v1/notifications",
-                                headers=headers, data=json.dumps(data))
-            print("[bunqcb_request] result: {} {}"
-                  .format(res.status_code, res.text))
+        item = source["translate"](obj, accname)
+        log.payload(LOG, label + " translated", item)
+        storage.store_large(tenant.kind("event_" + eventtype, tenantid),
+                            metaid, item, item["meta"]["timestamp"])
+        for hook in source["hooks"]:
+            hook(tenantid, item)
+        notify.send(dispatch(eventtype, tenantid, item), tenantid)
 
     except Exception:
-        traceback.print_exc()
-        print("[bunqcb_request] ERROR during handling bunq callback")
+        LOG.exception("%s during handling bunq callback", label)
         return 500
 
     return 200
 
-def bunq_callback_mutation():
-    """ Handle bunq callbacks of type MUTATION """
+
+###############################################################################
+# Trigger engine
+###############################################################################
+
+def dispatch(eventtype, tenantid, item):
+    """ Match an event against the triggers of all types fed by its event
+        type, and add it to their histories as their policy says. Returns
+        the identities of the triggers that fired. """
+    versions = triggerindex.get_versions(TRIGGER_KINDS, tenantid)
+    found = multimatch.scan(item)
+    triggerids = []
+    for triggertype, spec in TRIGGER_TYPES.items():
+        if spec["source"] != eventtype:
+            continue
+        try:
+            indexes = [triggerindex.get_index("trigger_" + triggertype,
+                                              tenantid, account, versions)
+                       for account in ["ANY", item["account"]]]
+            matches = []
+            for index in indexes:
+                matches.extend(match_triggers(triggertype, index, item,
+                                              found))
+            fired = spec["policy"](triggertype, tenantid, item, indexes,
+                                   matches)
+        except Exception:
+            # A broken trigger type must not keep the others from firing
+            LOG.exception("[bunqcb_%s] error matching %s triggers", eventtype,
+                          triggertype)
+            continue
+        for trigger, entry in fired:
+            triggerids.append(trigger["identity"])
+            history.add(triggertype, tenantid, trigger["identity"], entry)
+        LOG.info("[bunqcb_%s] matched %s triggers: %s", eventtype,
+                 triggertype, log.Json([trigger["identity"]
+                                        for trigger, _ in fired]))
+    return triggerids
+
+def fire_on_match(triggertype, tenantid, item, indexes, matches):
+    """ History policy: every matching event is added """
+    # pylint: disable=unused-argument
+    return [(trigger, item) for trigger in matches]
+
+def fire_on_change(triggertype, tenantid, item, indexes, matches):
+    """ History policy: an event is added when the conditions of a trigger
+        become true for the account, as kept in the <type>_state kind """
+    kind_state = tenant.kind(triggertype + "_state", tenantid)
+    state = storage.get_value(kind_state, item["account"])
+    if state is None:
+        state = initial_state(indexes)
+    newstate = {}
+    fired = []
+    for trigger in matches:
+        ident = trigger["identity"]
+        newstate[ident] = predicate.fields_hash(trigger["fields"])
+        if state.get(ident) != newstate[ident]:
+            fired.append((trigger, item))
+    if newstate != state:
+        storage.store_large(kind_state, item["account"], newstate)
+    return fired
+
+def fire_on_threshold(triggertype, tenantid, item, indexes, matches):
+    """ History policy: an aggregate event is added when the total of a
+        trigger crosses its threshold (see the aggregate module) """
+    # pylint: disable=unused-argument
+    eventkind = tenant.kind("event_" + TRIGGER_TYPES[triggertype]["events"],
+                            tenantid)
+    results = {}
+    fired = []
+    for trigger in matches:
+        key = predicate.fields_hash(trigger["fields"])
+        if key not in results:
+            try:
+                results[key] = aggregate.update(tenantid, trigger["fields"],
+                                                item)
+            except Exception:
+                LOG.exception("Error in %s trigger %s", triggertype,
+                              trigger["identity"])
+                results[key] = None
+            if results[key] is not None:
+                storage.store_large(eventkind, results[key]["meta"]["id"],
+                                    results[key],
+                                    results[key]["meta"]["timestamp"])
+        if results[key] is not None:
+            fired.append((trigger, results[key]))
+    return fired
+
+def get_events(eventkind, ids):
+    """ Return the events with the given ids in one batch, skipping events
+        that no longer exist """
+    return [event["value"] for event in storage.retrieve_multi(eventkind, ids)
+            if event is not None]
+
+def match_triggers(triggertype, index, item, found=None):
+    """ Return the triggers in the index that match the item, found is the
+        result of multimatch.scan on the item """
+    result = []
+    for triggers, pred in index.candidates(item):
+        try:
+            if pred.matches(item, found):
+                result.extend(triggers)
+        except Exception:
+            LOG.exception("Error in %s triggers %s", triggertype,
+                          ", ".join([t["identity"] for t in triggers]))
+    return result
+
+def initial_state(indexes):
+    """ Return the trigger state from the last flags of older triggers """
+    state = {}
+    for index in indexes:
+        for triggers, _ in index.triggers:
+            for trigger in triggers:
+                if trigger.get("last"):
+                    state[trigger["identity"]] = \
+                        predicate.fields_hash(trigger["fields"])
+    return state
+
+def preload_triggers():
+    """ Load the trigger routing data of all tenants, used on warmup """
+    count = 0
+    for tenantid in tenant.all_tenants():
+        versions = triggerindex.get_versions(TRIGGER_KINDS, tenantid)
+        for kind in TRIGGER_KINDS:
+            count += len(triggerindex.get_index(kind, tenantid, "ANY",
+                                                versions))
+    return count
+
+
+###############################################################################
+# IFTTT trigger polls
+###############################################################################
+
+def trigger_poll(triggertype):
+    """ Callback for the IFTTT trigger bunq_<triggertype> """
+    spec = TRIGGER_TYPES[triggertype]
+    label = "[trigger_{}]".format(triggertype)
     try:
         data = request.get_json()
-        print("[bunqcb_mutation] input: {}".format(json.dumps(data)))
-        payment = data["NotificationUrl"]["object"]["Payment"]
-        metaid = payment["id"]
-        if storage.seen("seen_mutation", metaid):
-            print("[bunqcb_mutation] duplicate transaction")
-            return 200
+        log.payload(LOG, label + " input", data)
 
-        iban = payment["alias"]["iban"]
-        valid, accname = util.check_valid_bunq_account(iban, "Mutation")
-        if not valid:
-            print("[bunqcb_mutation] trigger not enabled for this account")
-            return 200
+        if "triggerFields" not in data or \
+                any([field not in data["triggerFields"]
+                     for field in spec["fields"]]):
+            LOG.error("%s trigger field missing!", label)
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+        account = data["triggerFields"]["account"]
+        fields = data["triggerFields"]
 
-        item = {
-            "created_at": payment["created"],
-            "date": arrow.get(payment["created"]).format("YYYY-MM-DD"),
-            "type": mutation_type(payment),
-            "amount": payment["amount"]["value"],
-            "balance": payment["balance_after_mutation"]["value"],
-            "account": iban,
-            "account_name": accname,
-            "counterparty_account": counterparty_account(payment),
-            "counterparty_name": payment["counterparty_alias"]["display_name"],
-            "description": payment["description"],
-            "payment_id": metaid,
-            "meta": {
-                "id": metaid,
-                "timestamp": arrow.get(payment["created"]).timestamp
-            }
-        }
+        if "trigger_identity" not in data:
+            LOG.error("%s trigger_identity field missing!", label)
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+        identity = data["trigger_identity"]
 
-        print("[bunqcb_mutation] translated: {}".format(json.dumps(item)))
-        triggerids_1 = []
-        triggerids_2 = []
-        for account in ["ANY", iban]:
-            for trigger in storage.query("trigger_mutation",
-                                         "account", "=", account):
-                ident = trigger["identity"]
-                if check_fields("mutation", ident, item, trigger["fields"]):
-                    triggerids_1.append(ident)
-                    storage.insert_value_maxsize("trigger_mutation",
-                                                 ident+"_t", item, 50)
-            for trigger in storage.query("trigger_balance",
-                                         "account", "=", account):
-                ident = trigger["identity"]
-                if check_fields("balance", ident, item, trigger["fields"]):
-                    if not trigger["last"]:
-                        triggerids_2.append(ident)
-                        storage.insert_value_maxsize("trigger_balance",
-                                                     ident+"_t", item, 50)
-                        trigger["last"] = True
-                        storage.store("trigger_balance", ident, trigger)
-                elif trigger["last"]:
-                    trigger["last"] = False
-                    storage.store("trigger_balance", ident, trigger)
-        print("Matched mutation triggers:", json.dumps(triggerids_1))
-        print("Matched balance triggers:", json.dumps(triggerids_2))
-        data = {"data": []}
-        for triggerid in triggerids_1 + triggerids_2:
-            data["data"].append({"trigger_identity": triggerid})
-        if data["data"]:
-            headers = {
-                "IFTTT-Channel-Key": util.get_ifttt_service_key(),
-                "IFTTT-Service-Key": util.get_ifttt_service_key(),
-                "X-Request-ID": uuid.uuid4().hex,
-                "Content-Type": "application/json"
-            }
-            print("[bunqcb_mutation] to ifttt: {}".format(
-                json.dumps(data)))
-            res = requests.post("https://realtime.ifttt.com/v1/notifications",
-                                headers=headers, data=json.dumps(data))
-            print("[bunqcb_mutation] result: {} {}"
-                  .format(res.status_code, res.text))
+        limit = 50
+        if "limit" in data:
+            limit = data["limit"]
+
+        if account == "NL42BUNQ0123456789":
+            return spec["test"](limit)
+
+        if spec["validate"] is not None and not spec["validate"](fields):
+            LOG.error("%s invalid trigger fields!", label)
+            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
+
+        if data.get("cursor") and \
+                not history.valid_cursor(identity, str(data["cursor"])):
+            LOG.error("%s invalid cursor!", label)
+            return json.dumps({"errors": [{"message": "Invalid cursor"}]}), 400
+
+        timezone = "UTC"
+        if "user" in data and "timezone" in data["user"]:
+            timezone = data["user"]["timezone"]
 
+        return poll_history(triggertype, identity, fields, timezone, limit,
+                            data.get("since"), data.get("cursor"))
     except Exception:
-        traceback.print_exc()
-        print("[bunqcb_mutation] ERROR during handling bunq callback")
-        return 500
+        LOG.exception("%s cannot retrieve %s", label, spec["label"])
+        return json.dumps({"errors": [{"message": \
+                           "Cannot retrieve " + spec["label"]}]}), 400
+
+def poll_history(triggertype, identity, fields, timezone, limit, since=None,
+                 cursor=None):
+    """ Store the trigger if it is new or changed, and return the response
+        with the latest events in its history. Unchanged polls are answered
+        from the poll cache, with a 304 if the client has the same ETag.
+        With since (a meta.timestamp) or cursor (from a previous response)
+        set, a page of the history is returned with the cursor of the next
+        page. """
+    spec = TRIGGER_TYPES[triggertype]
+    account = fields["account"]
+    fieldsstr = json.dumps(fields)
+    tenantid = util.ifttt_tenant()
+    kind = tenant.kind("trigger_" + triggertype, tenantid)
+    paged = since is not None or cursor is not None
+    names = history.read(triggertype, tenantid, identity, limit, since,
+                         cursor)
+
+    cached = None
+    if not paged:
+        cached = pollcache.get(kind, identity, fieldsstr, names, timezone,
+                               limit)
+    if cached is None:
+        entity = storage.retrieve(kind, identity)
+        if entity is None or entity["account"] != account or \
+                json.dumps(entity["fields"]) != fieldsstr:
+            storage.store(kind, identity, {
+                "account": account,
+                "identity": identity,
+                "fields": fields,
+                "polled": cleanup.today()
+            })
+            LOG.info("[trigger_%s] %s trigger %s %s", triggertype,
+                     "storing new" if entity is None else "updating",
+                     account, fieldsstr)
+            triggerindex.changed("trigger_" + triggertype, tenantid)
+            if entity is None and spec["backfill"]:
+                backfill.start(tenantid, identity, fields)
+
+        eventkind = tenant.kind("event_" + spec["events"], tenantid)
+        if history.migrate(triggertype, tenantid, identity, eventkind):
+            names = history.read(triggertype, tenantid, identity, limit,
+                                 since, cursor)
+        transactions = get_events(eventkind, [history.event_id(name)
+                                              for name in names])
+        for trans in transactions:
+            trans["created_at"] = timeutil.to_zone(trans["created_at"],
+                                                   timezone)
+        LOG.debug("[trigger_%s] found %d transactions", triggertype,
+                  len(transactions))
+        response = {"data": transactions}
+        if paged and len(names) == limit:
+            response["cursor"] = names[-1]
+        if paged:
+            cached = pollcache.tag(json.dumps(response))
+        else:
+            cached = pollcache.put(kind, identity, fieldsstr, names,
+                                   timezone, limit, json.dumps(response))
+
+    cleanup.touch(kind, identity)
+    body, etag = cached
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag}
+    return body, 200, {"ETag": etag}
+
+def trigger_delete(triggertype, identity):
+    """ Delete a specific trigger identity for the IFTTT trigger
+        bunq_<triggertype> """
+    try:
+        tenantid = util.ifttt_tenant()
+        kind = tenant.kind("trigger_" + triggertype, tenantid)
+        pollcache.invalidate(kind, identity)
+        if storage.retrieve(kind, identity) is not None:
+            cleanup.remove(triggertype, tenantid, [identity])
 
-    return 200
+        return ""
+    except Exception:
+        LOG.exception("[trigger_%s_delete] cannot delete trigger", triggertype)
+        return json.dumps({"errors": [{"message": "Cannot delete trigger"}]}),\
+               400
 
 
 ###############################################################################
-# Helper methods for bunq callbacks
+# Translation of bunq objects to events
 ###############################################################################
 
+def request_item(obj, accname):
+    """ Translate a bunq request response to a request event """
+    created = timeutil.parse(obj["created"])
+    return {
+        "created_at": timeutil.utc_iso(created),
+        "date": created.strftime("%Y-%m-%d"),
+        "amount": obj["amount_inquired"]["value"],
+        "account": obj["alias"]["iban"],
+        "account_name": accname,
+        "counterparty_account": counterparty_account(obj),
+        "counterparty_name": obj["counterparty_alias"]["display_name"],
+        "description": obj["description"],
+        "request_id": obj["id"],
+        "meta": {
+            "id": obj["id"],
+            "timestamp": timeutil.epoch(created)
+        }
+    }
+
+def mutation_item(payment, accname):
+    """ Translate a bunq payment to a mutation event """
+    created = timeutil.parse(payment["created"])
+    return {
+        "created_at": timeutil.utc_iso(created),
+        "date": created.strftime("%Y-%m-%d"),
+        "type": mutation_type(payment),
+        "amount": payment["amount"]["value"],
+        "balance": payment["balance_after_mutation"]["value"],
+        "account": payment["alias"]["iban"],
+        "account_name": accname,
+        "counterparty_account": counterparty_account(payment),
+        "counterparty_name": payment["counterparty_alias"]["display_name"],
+        "description": payment["description"],
+        "payment_id": payment["id"],
+        "meta": {
+            "id": payment["id"],
+            "timestamp": timeutil.epoch(created)
+        }
+    }
+
 def mutation_type(payment):
     """ Return the type of a payment """
     muttype = "TRANSFER_OTHER"
@@ -235,191 +478,11 @@ def counterparty_account(payment):
         ctp_account = "Other"
     return ctp_account
 
-def check_fields(triggertype, triggerid, item, fields):
-    """ Check the conditional fields for a trigger """
-    try:
-        return check_types(item, fields) and check_comparators(item, fields)
-    except Exception:
-        print("Error in {} trigger {}".format(triggertype, triggerid))
-        traceback.print_exc()
-
-def check_types(item, fields):
-    """ Check the mutation type fields for a trigger """
-    result = True
-    if "type" in fields and fields["type"] != "ANY":
-        result = item["type"].startswith(fields["type"])
-    if "type_2" in fields and fields["type_2"] != "---":
-        result |= item["type"].startswith(fields["type_2"])
-    if "type_3" in fields and fields["type_3"] != "---":
-        result |= item["type"].startswith(fields["type_3"])
-    if "type_4" in fields and fields["type_4"] != "---":
-        result |= item["type"].startswith(fields["type_4"])
-    return result
-
-def check_comparators(item, fields):
-    """ Check the comparison fields for a trigger """
-    result = True
-    if "amount_comparator" in fields:
-        result &= check_field_num(item["amount"],
-                                  fields["amount_comparator"],
-                                  fields["amount_value"])
-    if "amount_comparator_2" in fields:
-        result &= check_field_num(item["amount"],
-                                  fields["amount_comparator_2"],
-                                  fields["amount_value_2"])
-    if "balance_comparator" in fields:
-        result &= check_field_num(item["balance"],
-                                  fields["balance_comparator"],
-                                  fields["balance_value"])
-    if "balance_comparator_2" in fields:
-        result &= check_field_num(item["balance"],
-                                  fields["balance_comparator_2"],
-                                  fields["balance_value_2"])
-    if "counterparty_name_comparator" in fields:
-        result &= check_field_str(item["counterparty_name"],
-                                  fields["counterparty_name_comparator"],
-                                  fields["counterparty_name_value"])
-    if "counterparty_name_comparator_2" in fields:
-        result &= check_field_str(item["counterparty_name"],
-                                  fields["counterparty_name_comparator_2"],
-                                  fields["counterparty_name_value_2"])
-    if "counterparty_account_comparator" in fields:
-        result &= check_field_str(item["counterparty_account"],
-                                  fields["counterparty_account_comparator"],
-                                  fields["counterparty_account_value"])
-    if "counterparty_account_comparator_2" in fields:
-        result &= check_field_str(item["counterparty_account"],
-                                  fields["counterparty_account_comparator_2"],
-                                  fields["counterparty_account_value_2"])
-    if "description_comparator" in fields:
-        result &= check_field_str(item["description"],
-                                  fields["description_comparator"],
-                                  fields["description_value"])
-    if "description_comparator_2" in fields:
-        result &= check_field_str(item["description"],
-                                  fields["description_comparator_2"],
-                                  fields["description_value_2"])
-    return result
-
-def check_field_num(orig, comparator, target):
-    """ Check a numeric field """
-    result = False
-    if comparator == "ignore":
-        result = True
-    elif comparator == "equal" and float(orig) == float(target):
-        result = True
-    elif comparator == "not_equal" and float(orig) != float(target):
-        result = True
-    elif comparator == "above" and float(orig) > float(target):
-        result = True
-    elif comparator == "above_equal" and float(orig) >= float(target):
-        result = True
-    elif comparator == "below" and float(orig) < float(target):
-        result = True
-    elif comparator == "below_equal" and float(orig) <= float(target):
-        result = True
-    elif comparator == "in" and orig in json.loads(target):
-        result = True
-    elif comparator == "not_in" and orig not in json.loads(target):
-        result = True
-    return result
-
-def check_field_str(orig, comparator, target):
-    """ Check a string field """
-    result = False
-    if comparator in ["equal_nc", "not_equal_nc", "cont_nc", "not_cont_nc",
-                      "in_nc", "not_in_nc"]:
-        orig = orig.casefold()
-        target = target.casefold()
-    if comparator == "ignore":
-        result = True
-    elif comparator in ["equal", "equal_nc"] and orig == target:
-        result = True
-    elif comparator in ["not_equal", "not_equal_nc"] and orig != target:
-        result = True
-    elif comparator in ["cont", "cont_nc"] and orig.find(target) > -1:
-        result = True
-    elif comparator in ["not_cont", "not_cont_nc"] and orig.find(target) == -1:
-        result = True
-    elif comparator in ["in", "in_nc"] and orig in json.loads(target):
-        result = True
-    elif comparator in ["not_in", "not_in_nc"] and orig not in \
-                                                   json.loads(target):
-        result = True
-    return result
-
 
 ###############################################################################
-# IFTTT trigger bunq_mutation
+# Test data for the IFTTT endpoint tests
 ###############################################################################
 
-def trigger_mutation():
-    """ Callback for IFTTT trigger bunq_mutation """
-    try:
-        data = request.get_json()
-        print("[trigger_mutation] input: {}".format(json.dumps(data)))
-
-        if "triggerFields" not in data or\
-                "account" not in data["triggerFields"]:
-            print("[trigger_mutation] ERROR: account field missing!")
-            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
-        account = data["triggerFields"]["account"]
-        fields = data["triggerFields"]
-        fieldsstr = json.dumps(fields)
-
-        if "trigger_identity" not in data:
-            print("[trigger_mutation] ERROR: trigger_identity field missing!")
-            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
-        identity = data["trigger_identity"]
-
-        limit = 50
-        if "limit" in data:
-            limit = data["limit"]
-
-        if account == "NL42BUNQ0123456789":
-            return trigger_mutation_test(limit)
-
-        timezone = "UTC"
-        if "user" in data and "timezone" in data["user"]:
-            timezone = data["user"]["timezone"]
-
-        entity = storage.retrieve("trigger_mutation", identity)
-        if entity is not None:
-            if entity["account"] != account or \
-                    json.dumps(entity["fields"]) != fieldsstr:
-                storage.store("trigger_mutation", identity, {
-                    "account": account,
-                    "identity": identity,
-                    "fields": fields
-                })
-                print("[trigger_mutation] updating trigger {} {}"
-                      .format(account, fieldsstr))
-        else:
-            storage.store("trigger_mutation", identity, {
-                "account": account,
-                "identity": identity,
-                "fields": fields
-            })
-            print("[trigger_mutation] storing new trigger {} {}"
-                  .format(account, fieldsstr))
-
-        transactions = storage.get_value("trigger_mutation", identity+"_t")
-        if transactions is None:
-            transactions = []
-        for trans in transactions:
-            trans["created_at"] = arrow.get(trans["created_at"])\
-                                  .to(timezone).isoformat()
-
-        print("[trigger_mutation] Found {} transactions"
-              .format(len(transactions)))
-        return json.dumps({"data": transactions[:limit]})
-    except Exception:
-        traceback.print_exc()
-        print("[trigger_mutation] ERROR: cannot retrieve transactions")
-        return json.dumps({"errors": [{"message": \
-                           "Cannot retrieve transactions"}]}), 400
-
-
 def trigger_mutation_test(limit):
     """ Test data for IFTTT trigger bunq_mutation """
     result = [{
@@ -474,95 +537,6 @@ def trigger_mutation_test(limit):
     return json.dumps({"data": result[:limit]})
 
 
-def trigger_mutation_delete(identity):
-    """ Delete a specific trigger identity for IFTTT trigger bunq_mutation """
-    try:
-        for index in storage.query_indexes("mutation_"+identity):
-            storage.remove("mutation_"+identity, index)
-        storage.remove("trigger_mutation", identity)
-
-        return ""
-    except Exception:
-        traceback.print_exc()
-        print("[trigger_mutation_delete] ERROR: cannot delete trigger")
-        return json.dumps({"errors": [{"message": "Cannot delete trigger"}]}),\
-               400
-
-
-###############################################################################
-# IFTTT trigger bunq_balance
-###############################################################################
-
-def trigger_balance():
-    """ Callback for IFTTT trigger bunq_balance """
-    try:
-        data = request.get_json()
-        print("[trigger_balance] input: {}".format(json.dumps(data)))
-
-        if "triggerFields" not in data or\
-                "account" not in data["triggerFields"]:
-            print("[trigger_balance] ERROR: account field missing!")
-            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
-        account = data["triggerFields"]["account"]
-        fields = data["triggerFields"]
-        fieldsstr = json.dumps(fields)
-
-        if "trigger_identity" not in data:
-            print("[trigger_balance] ERROR: trigger_identity field missing!")
-            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
-        identity = data["trigger_identity"]
-
-        limit = 50
-        if "limit" in data:
-            limit = data["limit"]
-
-        if account == "NL42BUNQ0123456789":
-            return trigger_balance_test(limit)
-
-        timezone = "UTC"
-        if "user" in data and "timezone" in data["user"]:
-            timezone = data["user"]["timezone"]
-
-        entity = storage.retrieve("trigger_balance", identity)
-        if entity is not None:
-            if entity["account"] != account or \
-                    json.dumps(entity["fields"]) != fieldsstr or \
-                    "last" not in entity:
-                storage.store("trigger_balance", identity, {
-                    "account": account,
-                    "identity": identity,
-                    "fields": fields,
-                    "last": False
-                })
-                print("[trigger_balance] updating trigger {} {}"
-                      .format(account, fieldsstr))
-        else:
-            storage.store("trigger_balance", identity, {
-                "account": account,
-                "identity": identity,
-                "fields": fields,
-                "last": False
-            })
-            print("[trigger_balance] storing new trigger {} {}"
-                  .format(account, fieldsstr))
-
-        transactions = storage.get_value("trigger_balance", identity+"_t")
-        if transactions is None:
-            transactions = []
-        for trans in transactions:
-            trans["created_at"] = arrow.get(trans["created_at"])\
-                                  .to(timezone).isoformat()
-
-        print("[trigger_balance] Found {} transactions"
-              .format(len(transactions)))
-        return json.dumps({"data": transactions[:limit]})
-    except Exception:
-        traceback.print_exc()
-        print("[trigger_balance] ERROR: cannot retrieve balances")
-        return json.dumps({"errors": [{"message": \
-                           "Cannot retrieve balances"}]}), 400
-
-
 def trigger_balance_test(limit):
     """ Test data for IFTTT trigger bunq_balance """
     result = [{
@@ -596,92 +570,6 @@ def trigger_balance_test(limit):
     return json.dumps({"data": result[:limit]})
 
 
-def trigger_balance_delete(identity):
-    """ Delete a specific trigger identity for IFTTT trigger bunq_balance """
-    try:
-        for index in storage.query_indexes("balance_"+identity):
-            storage.remove("balance_"+identity, index)
-        storage.remove("trigger_balance", identity)
-
-        return ""
-    except Exception:
-        traceback.print_exc()
-        print("[trigger_balance_delete] ERROR: cannot delete trigger")
-        return json.dumps({"errors": [{"message": "Cannot delete trigger"}]}),\
-               400
-
-
-###############################################################################
-# IFTTT trigger bunq_request
-###############################################################################
-
-def trigger_request():
-    """ Callback for IFTTT trigger bunq_request """
-    try:
-        data = request.get_json()
-        print("[trigger_request] input: {}".format(json.dumps(data)))
-
-        if "triggerFields" not in data or \
-                "account" not in data["triggerFields"]:
-            print("[trigger_request] ERROR: account field missing!")
-            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
-        account = data["triggerFields"]["account"]
-        fields = data["triggerFields"]
-        fieldsstr = json.dumps(fields)
-
-        if "trigger_identity" not in data:
-            print("[trigger_request] ERROR: trigger_identity field missing!")
-            return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
-        identity = data["trigger_identity"]
-
-        limit = 50
-        if "limit" in data:
-            limit = data["limit"]
-
-        if account == "NL42BUNQ0123456789":
-            return trigger_request_test(limit)
-
-        timezone = "UTC"
-        if "user" in data and "timezone" in data["user"]:
-            timezone = data["user"]["timezone"]
-
-        entity = storage.retrieve("trigger_request", identity)
-        if entity is not None:
-            if entity["account"] != account or \
-                    json.dumps(entity["fields"]) != fieldsstr:
-                storage.store("trigger_request", identity, {
-                    "account": account,
-                    "identity": identity,
-                    "fields": fields
-                })
-                print("[trigger_request] updating trigger {} {}"
-                      .format(account, fieldsstr))
-        else:
-            storage.store("trigger_request", identity, {
-                "account": account,
-                "identity": identity,
-                "fields": fields
-            })
-            print("[trigger_request] storing new trigger {} {}"
-                  .format(account, fieldsstr))
-
-        transactions = storage.get_value("trigger_request", identity+"_t")
-        if transactions is None:
-            transactions = []
-        for trans in transactions:
-            trans["created_at"] = arrow.get(trans["created_at"])\
-                                  .to(timezone).isoformat()
-
-        print("[trigger_request] Found {} transactions"
-              .format(len(transactions)))
-        return json.dumps({"data": transactions[:limit]})
-    except Exception:
-        traceback.print_exc()
-        print("[trigger_request] ERROR: cannot retrieve requests")
-        return json.dumps({"errors": [{"message": \
-                           "Cannot retrieve requests"}]}), 400
-
-
 def trigger_request_test(limit):
     """ Test data for IFTTT trigger bunq_request """
     result = [{
@@ -727,19 +615,151 @@ def trigger_request_test(limit):
     return json.dumps({"data": result[:limit]})
 
 
-def trigger_request_delete(identity):
-    """ Delete a specific trigger identity for IFTTT trigger bunq_request """
-    try:
-        for index in storage.query_indexes("request_"+identity):
-            storage.remove("request_"+identity, index)
-        storage.remove("trigger_request", identity)
+def trigger_aggregate_test(limit):
+    """ Test data for IFTTT trigger bunq_aggregate """
+    result = [{
+        "created_at": "2018-01-05T11:25:15+00:00",
+        "date": "2018-01-05",
+        "type": "CARD_PAYMENT",
+        "amount": "-101.01",
+        "balance": "15.15",
+        "account": "NL42BUNQ0123456789",
+        "account_name": "Test account",
+        "counterparty_account": "Card",
+        "counterparty_name": "ACME Store Inc.",
+        "description": "POS transaction 1234567890",
+        "payment_id": "123e4567-e89b-12d3-a456-426655440001",
+        "period": "7",
+        "measure": "spent",
+        "total": "250.50",
+        "count": 3,
+        "meta": {
+            "id": "1",
+            "timestamp": "1515151515"
+        }
+    }, {
+        "created_at": "2014-10-24T09:03:34+00:00",
+        "date": "2014-10-24",
+        "type": "CARD_PAYMENT",
+        "amount": "-2.02",
+        "balance": "14.14",
+        "account": "NL42BUNQ0123456789",
+        "account_name": "Test account",
+        "counterparty_account": "Card",
+        "counterparty_name": "ACME Store Inc.",
+        "description": "POS transaction 2345678901",
+        "payment_id": "123e4567-e89b-12d3-a456-426655440002",
+        "period": "7",
+        "measure": "spent",
+        "total": "202.02",
+        "count": 5,
+        "meta": {
+            "id": "2",
+            "timestamp": "1414141414"
+        }
+    }, {
+        "created_at": "2008-05-30T04:20:12+00:00",
+        "date": "2008-05-30",
+        "type": "CARD_PAYMENT",
+        "amount": "-3.03",
+        "balance": "12.12",
+        "account": "NL42BUNQ0123456789",
+        "account_name": "Test account",
+        "counterparty_account": "Card",
+        "counterparty_name": "ACME Store Inc.",
+        "description": "POS transaction 3456789012",
+        "payment_id": "123e4567-e89b-12d3-a456-426655440003",
+        "period": "7",
+        "measure": "spent",
+        "total": "200.03",
+        "count": 8,
+        "meta": {
+            "id": "3",
+            "timestamp": "1212121212"
+        }
+    }]
+    return json.dumps({"data": result[:limit]})
 
-        return ""
-    except Exception:
-        traceback.print_exc()
-        print("[trigger_request_delete] ERROR: cannot delete trigger")
-        return json.dumps({"errors": [{"message": "Cannot delete trigger"}]}),\
-               400
+
+###############################################################################
+# Trigger registry
+###############################################################################
+
+# Bunq callbacks producing events:
+# - object: the bunq object in the callback
+# - permission: the account permission needed to process the callback
+# - translate: returns the event for the object and the account name
+# - hooks: called with the tenant and the event for every stored event
+SOURCES = {
+    "mutation": {
+        "object": "Payment",
+        "permission": "Mutation",
+        "translate": mutation_item,
+        "hooks": [rollup.add],
+    },
+    "request": {
+        "object": "RequestResponse",
+        "permission": "Request",
+        "translate": request_item,
+        "hooks": [],
+    },
+}
+
+# Trigger types, served as IFTTT trigger bunq_<type>:
+# - source: the event type the triggers are matched against
+# - events: the event type the history refers to
+# - policy: selects the (trigger, event) pairs added to the histories, see
+#   the fire_on_... functions
+# - fields: the trigger fields that are required
+# - validate: checks the trigger fields on a poll, if set
+# - backfill: whether new triggers get recent payments in their history
+# - label: what the history contains, used in error messages
+# - test: returns test data for the IFTTT endpoint tests
+TRIGGER_TYPES = {
+    "mutation": {
+        "source": "mutation",
+        "events": "mutation",
+        "policy": fire_on_match,
+        "fields": ["account"],
+        "validate": None,
+        "backfill": True,
+        "label": "transactions",
+        "test": trigger_mutation_test,
+    },
+    "balance": {
+        "source": "mutation",
+        "events": "mutation",
+        "policy": fire_on_change,
+        "fields": ["account"],
+        "validate": None,
+        "backfill": False,
+        "label": "balances",
+        "test": trigger_balance_test,
+    },
+    "request": {
+        "source": "request",
+        "events": "request",
+        "policy": fire_on_match,
+        "fields": ["account"],
+        "validate": None,
+        "backfill": False,
+        "label": "requests",
+        "test": trigger_request_test,
+    },
+    "aggregate": {
+        "source": "mutation",
+        "events": "aggregate",
+        "policy": fire_on_threshold,
+        "fields": ["account", "period", "measure", "threshold_comparator",
+                   "threshold_value"],
+        "validate": aggregate.valid,
+        "backfill": False,
+        "label": "aggregates",
+        "test": trigger_aggregate_test,
+    },
+}
+
+TRIGGER_KINDS = ["trigger_" + triggertype for triggertype in TRIGGER_TYPES]
 
 
 ###############################################################################
@@ -750,16 +770,16 @@ def trigger_oauth_expires():
     """ Callback for IFTTT trigger bunq_oauth_expires """
     try:
         data = request.get_json()
-        print("[trigger_oauthexp] input: {}".format(json.dumps(data)))
+        log.payload(LOG, "[trigger_oauthexp] input", data)
 
         if "triggerFields" not in data or \
                 "hours" not in data["triggerFields"]:
-            print("[trigger_oauthexp] ERROR: hours field missing!")
+            LOG.error("[trigger_oauthexp] hours field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
         hours = data["triggerFields"]["hours"]
 
         if "trigger_identity" not in data:
-            print("[trigger_oauthexp] ERROR: trigger_identity field missing!")
+            LOG.error("[trigger_oauthexp] trigger_identity field missing!")
             return json.dumps({"errors": [{"message": "Invalid data"}]}), 400
 
         limit = 50
@@ -774,27 +794,26 @@ def trigger_oauth_expires():
             timezone = data["user"]["timezone"]
 
         transactions = []
-        value = storage.get_value("bunq2IFTTT", "bunq_oauth")
+        value = storage.get_value("bunq2IFTTT",
+                                  tenant.oauth_index(util.ifttt_tenant()))
         if value is not None:
             timestamp = value["timestamp"] + 3600 * (90*24 - int(hours))
             if timestamp <= time.time():
                 transactions = [{
-                    "created_at": arrow.get(timestamp)\
-                                  .to(timezone).isoformat(),
-                    "expires_at": arrow.get(value["timestamp"] + 90*24*3600)\
-                                  .to(timezone).isoformat(),
+                    "created_at": timeutil.from_epoch(timestamp, timezone),
+                    "expires_at": timeutil.from_epoch(
+                        value["timestamp"] + 90*24*3600, timezone),
                     "meta": {
                         "id": str(timestamp),
                         "timestamp": str(timestamp),
                     }
                 }]
 
-        print("[trigger_oauthexp] Found {} transactions"
-              .format(len(transactions)))
+        LOG.debug("[trigger_oauthexp] found %d transactions",
+                  len(transactions))
         return json.dumps({"data": transactions[:limit]})
     except Exception:
-        traceback.print_exc()
-        print("[trigger_oauthexp] ERROR: cannot retrieve oauth expiry data")
+        LOG.exception("[trigger_oauthexp] cannot retrieve oauth expiry data")
         return json.dumps({"errors": [{"message": \
                            "Cannot retrieve oauth expiry data"}]}), 400
 
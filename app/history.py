@@ -0,0 +1,131 @@
+"""
+Trigger histories
+
+The history of a trigger references the events it matched in the event
+store. Every reference is a separate record of the kind history_<type>
+(per tenant), named <identity>|<LATEST - meta.timestamp>|<event id> with a
+zero padded, inverted timestamp. The records of a trigger are thus ordered
+newest first by name, which the built-in key index supports without a
+composite index on the per tenant kinds, and range queries on the record
+names read only what is needed:
+- the latest events, for a poll
+- the events newer than a given meta.timestamp
+- the next page of events, where the cursor is the name of the last record
+  of the previous page
+
+Retention is configured per trigger type as a maximum age and a maximum
+number of events, and enforced on a fraction of the inserts. Histories in
+the older <identity>_t records are moved to this layout on the first poll.
+"""
+
+import random
+import time
+
+import storage
+import tenant
+
+# Maximum age in days and maximum number of events kept per trigger
+RETENTION = {
+    "mutation": {"days": 90, "events": 1000},
+    "balance": {"days": 90, "events": 1000},
+    "request": {"days": 90, "events": 1000},
+    "aggregate": {"days": 90, "events": 1000},
+}
+
+# Fraction of the inserts after which old records are removed
+PRUNE_FRACTION = 0.1
+
+SEP = "|"
+LAST = "~" # sorts after all record names of a trigger
+LATEST = 9999999999 # timestamps are stored as LATEST - timestamp
+
+
+def kind(triggertype, tenantid):
+    """ Return the storage kind of the histories of a trigger type """
+    return tenant.kind("history_" + triggertype, tenantid)
+
+def record_name(identity, timestamp, eventid=""):
+    """ Return the name of a history record """
+    return "{}{}{:010d}{}{}".format(identity, SEP, LATEST - int(timestamp),
+                                    SEP, eventid)
+
+def record_timestamp(name):
+    """ Return the timestamp of a history record name """
+    return LATEST - int(name.rsplit(SEP, 2)[1])
+
+def event_id(name):
+    """ Return the event id of a history record name """
+    return name.rsplit(SEP, 1)[1]
+
+def add(triggertype, tenantid, identity, item):
+    """ Add an event to the history of a trigger """
+    storage.store_large(kind(triggertype, tenantid),
+                        record_name(identity, item["meta"]["timestamp"],
+                                    item["meta"]["id"]),
+                        item["meta"]["id"])
+    if random.random() < PRUNE_FRACTION:
+        prune(triggertype, tenantid, identity)
+
+def valid_cursor(identity, cursor):
+    """ Return whether a cursor is the name of a record of the trigger """
+    return cursor.startswith(identity + SEP)
+
+def read(triggertype, tenantid, identity, limit, since=None, cursor=None):
+    """ Return the names of the latest history records, newest first. Only
+        records newer than the since timestamp and older than the cursor
+        are returned. Raises ValueError for a cursor of another trigger. """
+    start = identity + SEP
+    if cursor:
+        if not valid_cursor(identity, cursor):
+            raise ValueError("invalid cursor")
+        start = cursor
+    end = identity + SEP + LAST
+    if since is not None:
+        end = record_name(identity, since)[:-len(SEP)]
+    names = storage.query_range(kind(triggertype, tenantid), start, end,
+                                limit=limit + 1 if cursor else limit)
+    if cursor and names and names[0] == cursor:
+        return names[1:]
+    return names[:limit]
+
+def prune(triggertype, tenantid, identity):
+    """ Remove the records beyond the retention of the trigger type """
+    retention = RETENTION[triggertype]
+    histkind = kind(triggertype, tenantid)
+    cutoff = time.time() - retention["days"] * 24 * 3600
+    names = storage.query_range(histkind, identity + SEP,
+                                identity + SEP + LAST)
+    storage.remove_multi(histkind, [
+        name for num, name in enumerate(names)
+        if num >= retention["events"] or record_timestamp(name) < cutoff])
+
+def remove_all(triggertype, tenantid, identity):
+    """ Remove the history of a trigger """
+    histkind = kind(triggertype, tenantid)
+    storage.remove_multi(histkind, storage.query_range(
+        histkind, identity + SEP, identity + SEP + LAST))
+
+def migrate(triggertype, tenantid, identity, eventkind):
+    """ Move a history stored in an <identity>_t record to this layout,
+        returns whether there was anything to move """
+    oldkind = tenant.kind("trigger_" + triggertype, tenantid)
+    entries = storage.get_value(oldkind, identity+"_t")
+    if entries is None:
+        return False
+    ids = [entry for entry in entries if not isinstance(entry, dict)]
+    events = dict(zip(ids, storage.retrieve_multi(eventkind, ids)))
+    for entry in entries:
+        if isinstance(entry, dict): # stored before the event store existed
+            storage.store_large(eventkind, entry["meta"]["id"], entry,
+                                entry["meta"]["timestamp"])
+            item = entry
+        elif events[entry] is not None:
+            item = events[entry]["value"]
+        else:
+            continue
+        storage.store_large(kind(triggertype, tenantid),
+                            record_name(identity, item["meta"]["timestamp"],
+                                        item["meta"]["id"]),
+                            item["meta"]["id"])
+    storage.remove(oldkind, identity+"_t")
+    return True
@@ -0,0 +1,54 @@
+"""
+Import time report
+
+Measures how long importing the app takes, which is what a new instance pays
+on a cold start before it can serve the first request. Reports the time per
+module imported by main (in milliseconds) and compares the time spent outside
+of Flask (the part this app controls) against a target.
+
+Usage: python importreport.py [target_ms]
+"""
+
+import subprocess
+import sys
+
+# Target for the import time of the app excluding Flask, in milliseconds
+TARGET_MS = 80
+
+
+def measure():
+    """ Import main in a fresh interpreter and return the timings """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                           "import main"], stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    timings = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue # header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        timings.append((depth, name.strip(), int(cumulative) / 1000))
+        # Children are reported before their parent, so drop everything
+        # imported by the interpreter startup before main
+        if depth == 0 and name.strip() != "main":
+            timings = []
+    return timings
+
+def report(target_ms=TARGET_MS):
+    """ Print the per module import time report """
+    timings = measure()
+    total = timings[-1][2]
+    direct = [(millis, name) for depth, name, millis in timings if depth == 1]
+    flask = sum([millis for millis, name in direct if name == "flask"])
+    for millis, name in sorted(direct, reverse=True):
+        print("{:>10.1f} ms  {}".format(millis, name))
+    print("{:>10.1f} ms  total".format(total))
+    print("{:>10.1f} ms  excluding flask (target: {} ms)"
+          .format(total - flask, target_ms))
+    return total - flask <= target_ms
+
+
+if __name__ == "__main__":
+    sys.exit(0 if report(*[int(arg) for arg in sys.argv[1:]]) else 1)
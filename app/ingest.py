@@ -0,0 +1,152 @@
+"""
+Callback ingestion queue
+
+The bunq callback endpoints only validate the payload and append it to a
+durable queue, so bunq gets its answer right away. A pool of worker threads
+drains the queue through the event processing (matching, histories and IFTTT
+notifications), which absorbs bursts of callbacks.
+
+In ordered mode (the default) the callbacks are sharded by IBAN onto worker
+lanes. Each lane processes the events of its accounts in the order they were
+created at bunq, waiting HOLD seconds for events that arrive out of order,
+while the lanes run in parallel. This keeps e.g. the edge detection of the
+balance triggers correct. Without ordering, callbacks go to the lanes in
+turn.
+
+The queue is kept in storage, as records of the kind QUEUE_KIND ordered by
+the time they were received. A record is removed once it is processed.
+Records left behind by an instance that stopped are picked up again when
+the workers start on another instance, and by the sync cron job, so they are
+not stuck until the next instance starts. Records that are still queued on
+this instance are skipped; other duplicates are filtered by the seen check
+of the event processing.
+"""
+# pylint: disable=broad-except,global-statement,import-outside-toplevel
+
+import itertools
+import queue
+import threading
+import time
+import uuid
+import zlib
+
+import log
+import storage
+
+LOG = log.get_logger("ingest")
+
+QUEUE_KIND = "callback_queue"
+
+# Number of worker threads (lanes) processing callbacks
+WORKERS = 4
+
+# Process the events of an account in order of creation
+ORDERED = True
+
+# Seconds to wait for earlier events of a lane before processing an event
+HOLD = 0.5
+
+# Attempts to process a callback before it is dropped
+ATTEMPTS = 3
+
+# Records older than this many seconds are considered abandoned
+RECOVER_AFTER = 300
+
+# Callback type to the bunq object holding the event
+OBJECTS = {
+    "mutation": "Payment",
+    "request": "RequestResponse",
+}
+
+_LANES = []
+_NEXT = itertools.count()
+_LOCK = threading.Lock()
+
+# Keys of the records queued on this instance
+_PENDING = set()
+
+
+def enqueue(cbtype, data):
+    """ Store a callback in the queue and hand it to the workers """
+    received = time.time()
+    key = "{:.6f}_{}".format(received, uuid.uuid4().hex)
+    record = {"type": cbtype, "data": data, "received": received,
+              "attempts": 0}
+    storage.store_large(QUEUE_KIND, key, record)
+    start_workers()
+    put(key, record)
+
+def put(key, record):
+    """ Hand a callback to the lane of its account """
+    obj = record["data"]["NotificationUrl"]["object"][OBJECTS[record["type"]]]
+    if ORDERED:
+        lane = zlib.crc32(obj["alias"]["iban"].encode("utf-8")) % len(_LANES)
+    else:
+        lane = next(_NEXT) % len(_LANES)
+    _PENDING.add(key)
+    _LANES[lane].put((obj.get("created", ""), key, record))
+
+def start_workers():
+    """ Start the worker threads, recovering abandoned records first """
+    with _LOCK:
+        if _LANES:
+            return
+        lanes = [queue.PriorityQueue() for _ in range(WORKERS)]
+        for num, lane in enumerate(lanes):
+            thread = threading.Thread(target=worker, args=(lane,),
+                                      daemon=True,
+                                      name="ingest-{}".format(num))
+            thread.start()
+        _LANES.extend(lanes)
+    recover()
+
+def recover():
+    """ Queue the records that were not processed by a stopped instance,
+        returns their number """
+    start_workers()
+    cutoff = time.time() - RECOVER_AFTER
+    records = [(entity["id"], entity["value"])
+               for entity in storage.query_all(QUEUE_KIND)
+               if entity["value"]["received"] < cutoff
+               and entity["id"] not in _PENDING]
+    for key, record in sorted(records):
+        put(key, record)
+    if records:
+        LOG.info("[ingest] recovered %d callbacks", len(records))
+    return len(records)
+
+def worker(lane):
+    """ Process the queued callbacks of a lane, oldest event first """
+    while True:
+        created, key, record = lane.get()
+        wait = record["received"] + HOLD - time.time()
+        if ORDERED and wait > 0 and record["attempts"] == 0:
+            # An earlier event of the lane may still arrive
+            lane.put((created, key, record))
+            time.sleep(wait)
+            continue
+        try:
+            process(key, record)
+        except Exception:
+            LOG.exception("[ingest] error processing callback %s", key)
+            _PENDING.discard(key)
+
+def process(key, record):
+    """ Process a callback, retry it later if processing failed """
+    import event
+    handlers = {
+        "mutation": event.process_mutation,
+        "request": event.process_request,
+    }
+    status = handlers[record["type"]](record["data"],
+                                      retry=record["attempts"] > 0)
+    record["attempts"] += 1
+    if status == 500 and record["attempts"] < ATTEMPTS:
+        storage.store_large(QUEUE_KIND, key, record)
+        threading.Timer(2 ** record["attempts"], put, [key, record]).start()
+        return
+    if status == 500:
+        LOG.error("[ingest] dropping callback %s after %d attempts", key,
+                  record["attempts"])
+    storage.remove(QUEUE_KIND, key)
+    _PENDING.discard(key)
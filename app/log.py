@@ -0,0 +1,112 @@
+"""
+Logging
+
+Structured logging for the app. Log records are put on a queue by the
+calling thread and written by a background thread as one JSON object per
+line, which App Engine picks up as structured log entries. IBANs, keys and
+tokens are redacted before a line is written.
+
+Each subsystem (event, bunq, card, ...) has its own logger, with levels
+configured through environment variables:
+- LOG_LEVEL: the default level, INFO if not set
+- LOG_LEVELS: levels per subsystem, e.g. "event=DEBUG,bunq=WARNING"
+- LOG_SAMPLE: the fraction of payloads logged at INFO level, 0.01 if not set
+  (all payloads are logged at DEBUG level)
+
+Messages use logging's lazy %-formatting, so a payload is only serialized
+when its line is actually emitted.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+
+ROOT = "bunq2ifttt"
+
+_LISTENER = None
+_LOCK = threading.Lock()
+
+_REDACTIONS = [
+    (re.compile(r"-----BEGIN [A-Z ]+-----.*?-----END [A-Z ]+-----",
+                re.DOTALL), "[REDACTED KEY]"),
+    (re.compile(r"""(["'][^"']*(?:key|token|secret|authentication|"""
+                r"""password|code)[^"']*["']\s*:\s*)(["'])[^"']*\2""",
+                re.IGNORECASE), r"\1\2[REDACTED]\2"),
+    (re.compile(r"\b([A-Z]{2}\d{2})[A-Z0-9]{6,26}([A-Z0-9]{4})\b"),
+     r"\1...\2"),
+]
+
+
+def get_logger(subsystem):
+    """ Return the logger of a subsystem """
+    setup()
+    return logging.getLogger(ROOT + "." + subsystem)
+
+def setup():
+    """ Set up the queue handler and the writer thread, once """
+    global _LISTENER # pylint: disable=global-statement
+    with _LOCK:
+        if _LISTENER is not None:
+            return
+        records = queue.Queue()
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter())
+        _LISTENER = logging.handlers.QueueListener(records, output)
+        _LISTENER.start()
+        atexit.register(_LISTENER.stop)
+
+        root = logging.getLogger(ROOT)
+        root.addHandler(logging.handlers.QueueHandler(records))
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        root.propagate = False
+        for setting in os.getenv("LOG_LEVELS", "").split(","):
+            if "=" in setting:
+                name, level = setting.split("=", 1)
+                logging.getLogger(ROOT + "." + name.strip())\
+                       .setLevel(level.strip().upper())
+
+def payload(logger, label, data):
+    """ Log a payload, always at DEBUG level and sampled at INFO level """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s: %s", label, Json(data))
+    elif logger.isEnabledFor(logging.INFO) \
+            and random.random() < float(os.getenv("LOG_SAMPLE", "0.01")):
+        logger.info("%s (sampled): %s", label, Json(data))
+
+def redact(message):
+    """ Remove IBANs, keys and tokens from a log message """
+    for pattern, replacement in _REDACTIONS:
+        message = pattern.sub(replacement, message)
+    return message
+
+
+class Json:
+    """ Serializes a value to json when it is formatted """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as a redacted json object """
+
+    def format(self, record):
+        subsystem = record.name[len(ROOT) + 1:] or ROOT
+        return json.dumps({
+            "severity": record.levelname,
+            "time": record.created,
+            "subsystem": subsystem,
+            "thread": record.threadName,
+            "message": redact(record.getMessage()),
+        })
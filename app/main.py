@@ -2,27 +2,35 @@
 Main module serving the pages for the bunq2IFTTT appengine app
 """
 
+import functools
 import json
 import os
 
-import arrow
-
 from flask import Flask, request, render_template
 
 import auth
 import bunq
 import card
+import cleanup
 import event
+import ingest
+import log
 import payment
 import paymentrequest
+import rollup
 import storage
+import sync
 import targetbalance
+import tenant
 import util
+import warmup
 
 # pylint: disable=invalid-name
 app = Flask(__name__)
 # pylint: enable=invalid-name
 
+LOG = log.get_logger("main")
+
 
 ###############################################################################
 # Webpages
@@ -41,19 +49,24 @@ def home_get():
     iftttkeyset = (util.get_ifttt_service_key("") is not None)
     accounts = util.get_bunq_accounts_with_permissions(config)
     enableexternal = util.get_external_payment_enabled()
-    bunq_oauth = storage.get_value("bunq2IFTTT", "bunq_oauth")
-    if bunq_oauth is not None and bunqkeymode != "APIkey":
-        expire = arrow.get(bunq_oauth["timestamp"] + 90*24*3600)
-        oauth_expiry = "{} ({})".format(expire.humanize(), expire.isoformat())
-    else:
-        oauth_expiry = None
+    tenants = sorted(tenant.get_tenants())
+    oauth_expiry = []
+    for tenantid in tenant.all_tenants():
+        bunq_oauth = storage.get_value("bunq2IFTTT",
+                                       tenant.oauth_index(tenantid))
+        if bunq_oauth is not None and bunq.retrieve_config(
+                tenantid=tenantid).get("mode") != "APIkey":
+            import arrow # pylint: disable=import-outside-toplevel
+            expire = arrow.get(bunq_oauth["timestamp"] + 90*24*3600)
+            oauth_expiry.append((tenantid or "", "{} ({})".format(
+                expire.humanize(), expire.isoformat())))
     # Google AppEngine does not provide fixed ip addresses
     defaultallips = (os.getenv("GAE_INSTANCE") is not None)
 
     return render_template("main.html",\
         iftttkeyset=iftttkeyset, bunqkeymode=bunqkeymode, accounts=accounts,\
         enableexternal=enableexternal, defaultallips=defaultallips,\
-        oauth_expiry=oauth_expiry)
+        oauth_expiry=oauth_expiry, tenants=tenants)
 
 
 @app.route("/login", methods=["POST"])
@@ -87,7 +100,11 @@ def bunq_oauth_reauthorize():
     if cookie is None or cookie != util.get_session_cookie():
         return render_template("message.html", msgtype="danger", msg=\
             "Invalid request: session cookie not set or not valid")
-    return auth.bunq_oauth_reauthorize()
+    tenantid = request.args.get("tenant") or None
+    if tenantid is not None and tenantid not in tenant.get_tenants():
+        return render_template("message.html", msgtype="danger", msg=\
+            "Invalid request: unknown bunq user")
+    return auth.bunq_oauth_reauthorize(tenantid)
 
 @app.route("/auth", methods=["GET"])
 def set_bunq_oauth_response():
@@ -136,8 +153,7 @@ def check_ifttt_service_key():
     """ Helper method to check the IFTTT-Service-Key header """
     if "IFTTT-Service-Key" not in request.headers:
         return json.dumps({"errors": [{"message": "Missing IFTTT key"}]})
-    if request.headers["IFTTT-Service-Key"] \
-    != util.get_ifttt_service_key(request.headers["IFTTT-Service-Key"]):
+    if not util.ifttt_key_tenant(request.headers["IFTTT-Service-Key"])[0]:
         return json.dumps({"errors": [{"message": "Invalid IFTTT key"}]})
     return None
 
@@ -146,25 +162,60 @@ def check_ifttt_service_key():
 # Cron endpoints
 ###############################################################################
 
-@app.route("/cron/clean_seen")
-def clean_seen():
-    """ Clean the seen cache periodically """
+def valid_cron_call():
+    """ Return whether the request is a call from the cron service """
     if os.getenv("GAE_INSTANCE") is not None:
         if "X-Appengine-Cron" not in request.headers\
         or request.headers["X-Appengine-Cron"] != "true":
-            print("Invalid cron call")
-            return "Invalid cron call"
+            LOG.warning("[cron] invalid cron call")
+            return False
     else:
         host = request.host
         if host.find(":") > -1:
             host = host[:host.find(":")]
         if host not in ["127.0.0.1", "localhost"]:
-            return "Invalid cron call"
+            return False
+    return True
+
+@app.route("/cron/clean_seen")
+def clean_seen():
+    """ Clean the seen cache periodically """
+    if not valid_cron_call():
+        return "Invalid cron call"
 
     storage.clean_seen("seen_mutation")
     storage.clean_seen("seen_request")
     return ""
 
+@app.route("/cron/cleanup")
+def cron_cleanup():
+    """ Remove triggers that are no longer polled """
+    if not valid_cron_call():
+        return "Invalid cron call"
+
+    return str(cleanup.run())
+
+@app.route("/cron/sync")
+def cron_sync():
+    """ Recover payments for which no callback was received, and callbacks
+        left in the queue by a stopped instance """
+    if not valid_cron_call():
+        return "Invalid cron call"
+
+    ingest.recover()
+    return str(sync.sync_all())
+
+
+###############################################################################
+# Warmup endpoint
+###############################################################################
+
+@app.route("/_ah/warmup")
+def ah_warmup():
+    """ Prepare a new instance before it takes traffic """
+    warmup.warmup()
+    return ""
+
 
 ###############################################################################
 # Status / testing endpoints
@@ -245,10 +296,39 @@ def ifttt_test_setup():
                         "description_comparator_2": "not_equal",
                         "description_value_2": "Foo bar",
                     },
+                    "bunq_aggregate": {
+                        "account": test_account,
+                        "type": "ANY",
+                        "type_2": "ANY",
+                        "type_3": "ANY",
+                        "type_4": "ANY",
+                        "counterparty_name_comparator": "not_equal",
+                        "counterparty_name_value": "Foo bar",
+                        "counterparty_name_comparator_2": "not_equal",
+                        "counterparty_name_value_2": "Foo bar",
+                        "counterparty_account_comparator": "not_equal",
+                        "counterparty_account_value": "Foo bar",
+                        "counterparty_account_comparator_2": "not_equal",
+                        "counterparty_account_value_2": "Foo bar",
+                        "period": "7",
+                        "measure": "spent",
+                        "threshold_comparator": "above",
+                        "threshold_value": "200",
+                    },
                     "bunq_oauth_expires": {
                         "hours": "9876543210",
                     }
                 },
+                "queries": {
+                    "bunq_daily_totals": {
+                        "account": test_account,
+                        "days": "30",
+                    },
+                    "bunq_top_counterparties": {
+                        "account": test_account,
+                        "month": "this",
+                    },
+                },
                 "actions": {
                     "bunq_internal_payment": {
                         "amount": "1.23",
@@ -408,6 +488,14 @@ def ifttt_comparator_numeric_options():
            "description_comparator/options", methods=["POST"])
 @app.route("/ifttt/v1/triggers/bunq_request/fields/"\
            "description_comparator_2/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "counterparty_name_comparator/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "counterparty_name_comparator_2/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "counterparty_account_comparator/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "counterparty_account_comparator_2/options", methods=["POST"])
 def ifttt_comparator_alpha_options():
     """ Option values for alphanumeric comparators """
     errmsg = check_ifttt_service_key()
@@ -428,11 +516,16 @@ def ifttt_comparator_alpha_options():
         {"value": "not_in", "label": "not in [json array]"},
         {"value": "in_nc", "label": "in [json array] (ignore case)"},
         {"value": "not_in_nc", "label": "not in [json array] (ignore case)"},
+        {"value": "regex", "label": "matches [regular expression]"},
+        {"value": "regex_nc",
+         "label": "matches [regular expression] (ignore case)"},
     ]}
     return json.dumps(data)
 
 @app.route("/ifttt/v1/triggers/bunq_mutation/fields/"\
            "type/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "type/options", methods=["POST"])
 def ifttt_type_options_1():
     """ Option values for the first type field """
     return ifttt_type_options(True)
@@ -443,10 +536,41 @@ def ifttt_type_options_1():
            "type_3/options", methods=["POST"])
 @app.route("/ifttt/v1/triggers/bunq_mutation/fields/"\
            "type_4/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "type_2/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "type_3/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "type_4/options", methods=["POST"])
 def ifttt_type_options_2():
     """ Option values for the subsequent type fields """
     return ifttt_type_options(False)
 
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "measure/options", methods=["POST"])
+def ifttt_measure_options():
+    """ Option values for the measure of the aggregate trigger """
+    errmsg = check_ifttt_service_key()
+    if errmsg:
+        return errmsg, 401
+    return json.dumps({"data": [
+        {"value": "spent", "label": "total amount spent"},
+        {"value": "received", "label": "total amount received"},
+        {"value": "count", "label": "number of mutations"},
+    ]})
+
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "threshold_comparator/options", methods=["POST"])
+def ifttt_threshold_comparator_options():
+    """ Option values for the threshold of the aggregate trigger """
+    errmsg = check_ifttt_service_key()
+    if errmsg:
+        return errmsg, 401
+    return json.dumps({"data": [
+        {"value": "above", "label": "rises above"},
+        {"value": "above_equal", "label": "rises to or above"},
+    ]})
+
 def ifttt_type_options(first):
     """ Option values for the type fields """
     errmsg = check_ifttt_service_key()
@@ -483,8 +607,11 @@ def ifttt_type_options(first):
            "account/options", methods=["POST"])
 @app.route("/ifttt/v1/triggers/bunq_balance/fields/"\
            "account/options", methods=["POST"])
+@app.route("/ifttt/v1/triggers/bunq_aggregate/fields/"\
+           "account/options", methods=["POST"])
 def ifttt_account_options_mutation():
-    """ Option values for mutation/balance trigger account selection"""
+    """ Option values for mutation/balance/aggregate trigger account
+        selection"""
     return ifttt_account_options(True, "Mutation")
 
 @app.route("/ifttt/v1/triggers/bunq_request/fields/"\
@@ -553,8 +680,8 @@ def ifttt_account_options(include_any, enable_key):
     if errmsg:
         return errmsg, 401
 
-    config = bunq.retrieve_config()
-    accounts = util.get_bunq_accounts_with_permissions(config)
+    accounts = util.get_bunq_accounts_with_permissions(
+        util.get_ifttt_config())
 
     if include_any:
         data = {"data": [{"label": "ANY", "value": "ANY"}]}
@@ -641,6 +768,27 @@ def ifttt_target_balance_payment_type_options():
     }]})
 
 
+@app.route("/ifttt/v1/queries/bunq_daily_totals/fields/"\
+           "account/options", methods=["POST"])
+@app.route("/ifttt/v1/queries/bunq_top_counterparties/fields/"\
+           "account/options", methods=["POST"])
+def ifttt_account_options_query():
+    """ Option values for query account selection"""
+    return ifttt_account_options(False, "Mutation")
+
+@app.route("/ifttt/v1/queries/bunq_top_counterparties/fields/"\
+           "month/options", methods=["POST"])
+def ifttt_month_options():
+    """ Option values for the month of the top counterparties query """
+    errmsg = check_ifttt_service_key()
+    if errmsg:
+        return errmsg, 401
+    return json.dumps({"data": [
+        {"value": "this", "label": "this month"},
+        {"value": "last", "label": "last month"},
+    ]})
+
+
 ###############################################################################
 # Bunq callback endpoints
 ###############################################################################
@@ -659,59 +807,58 @@ def bunq2ifttt_request():
 
 
 ###############################################################################
-# Event trigger endpoints
+# Query endpoints
 ###############################################################################
 
-@app.route("/ifttt/v1/triggers/bunq_mutation", methods=["POST"])
-def trigger_mutation():
-    """ Retrieve bunq_mutation trigger items """
+@app.route("/ifttt/v1/queries/bunq_daily_totals", methods=["POST"])
+def query_daily_totals():
+    """ Retrieve bunq_daily_totals query items """
     errmsg = check_ifttt_service_key()
     if errmsg:
         return errmsg, 401
-    return event.trigger_mutation()
+    return rollup.query_daily_totals()
 
-@app.route("/ifttt/v1/triggers/bunq_mutation/trigger_identity/<triggerid>",
-           methods=["DELETE"])
-def trigger_mutation_delete(triggerid):
-    """ Delete a trigger_identity for the bunq_mutation trigger """
+@app.route("/ifttt/v1/queries/bunq_top_counterparties", methods=["POST"])
+def query_top_counterparties():
+    """ Retrieve bunq_top_counterparties query items """
     errmsg = check_ifttt_service_key()
     if errmsg:
         return errmsg, 401
-    return event.trigger_mutation_delete(triggerid)
+    return rollup.query_top_counterparties()
 
-@app.route("/ifttt/v1/triggers/bunq_balance", methods=["POST"])
-def trigger_balance():
-    """ Retrieve bunq_balance trigger items """
-    errmsg = check_ifttt_service_key()
-    if errmsg:
-        return errmsg, 401
-    return event.trigger_balance()
 
-@app.route("/ifttt/v1/triggers/bunq_balance/trigger_identity/<triggerid>",
-           methods=["DELETE"])
-def trigger_balance_delete(triggerid):
-    """ Delete a trigger_identity for the bunq_balance trigger """
-    errmsg = check_ifttt_service_key()
-    if errmsg:
-        return errmsg, 401
-    return event.trigger_balance_delete(triggerid)
+###############################################################################
+# Event trigger endpoints
+###############################################################################
 
-@app.route("/ifttt/v1/triggers/bunq_request", methods=["POST"])
-def trigger_request():
-    """ Retrieve bunq_balance trigger items """
+def trigger_poll(triggertype):
+    """ Retrieve trigger items of a trigger type from the registry """
     errmsg = check_ifttt_service_key()
     if errmsg:
         return errmsg, 401
-    return event.trigger_request()
+    return event.trigger_poll(triggertype)
 
-@app.route("/ifttt/v1/triggers/bunq_request/trigger_identity/<triggerid>",
-           methods=["DELETE"])
-def trigger_request_delete(triggerid):
-    """ Delete a trigger_identity for the bunq_request trigger """
+def trigger_delete(triggertype, triggerid):
+    """ Delete a trigger_identity of a trigger type from the registry """
     errmsg = check_ifttt_service_key()
     if errmsg:
         return errmsg, 401
-    return event.trigger_request_delete(triggerid)
+    return event.trigger_delete(triggertype, triggerid)
+
+def register_triggers():
+    """ Add the poll and delete endpoints of the registered trigger types """
+    for triggertype in event.TRIGGER_TYPES:
+        app.add_url_rule("/ifttt/v1/triggers/bunq_" + triggertype,
+                         "trigger_" + triggertype,
+                         functools.partial(trigger_poll, triggertype),
+                         methods=["POST"])
+        app.add_url_rule("/ifttt/v1/triggers/bunq_" + triggertype +
+                         "/trigger_identity/<triggerid>",
+                         "trigger_" + triggertype + "_delete",
+                         functools.partial(trigger_delete, triggertype),
+                         methods=["DELETE"])
+
+register_triggers()
 
 @app.route("/ifttt/v1/triggers/bunq_oauth_expires", methods=["POST"])
 def trigger_oauth_expires():
@@ -812,4 +959,5 @@ def ifttt_request_inquiry():
 ###############################################################################
 
 if __name__ == "__main__":
+    warmup.warmup()
     app.run(host="localhost", port=18000, debug=True)
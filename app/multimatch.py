@@ -0,0 +1,138 @@
+"""
+Multi-pattern substring matching
+
+Aho-Corasick automata over the targets of all "contains" conditions
+(cont/cont_nc/not_cont/not_cont_nc), one per item field and case mode. A
+single scan of e.g. the description reports which of the targets occur in
+it, instead of searching the description once for every trigger.
+
+Targets are registered when the predicates are compiled. When the triggers
+change, the trigger index replaces them by the targets of the predicates it
+still holds, so targets of removed triggers are not searched forever. An
+automaton is only rebuilt when its targets changed since the last scan.
+Conditions whose target is not (or no longer) in an automaton search the
+field directly.
+"""
+
+import threading
+
+_AUTOMATA = {}
+_LOCK = threading.Lock()
+
+
+class Automaton:
+    """ Aho-Corasick automaton over a set of patterns """
+
+    def __init__(self):
+        self.patterns = set()
+        self.empty = False
+        self._pending = False
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        self._known = frozenset()
+        self._lock = threading.Lock()
+
+    def add(self, pattern):
+        """ Register a pattern, the automaton is rebuilt on the next scan """
+        with self._lock:
+            if pattern not in self.patterns:
+                self.patterns.add(pattern)
+                self._pending = True
+
+    def replace(self, patterns):
+        """ Replace the registered patterns, the automaton is rebuilt on the
+            next scan """
+        with self._lock:
+            if patterns != self.patterns:
+                self.patterns = set(patterns)
+                self._pending = True
+
+    def build(self):
+        """ Build the trie with failure links for all registered patterns """
+        goto = [{}]
+        out = [set()]
+        for pattern in self.patterns:
+            node = 0
+            for char in pattern:
+                nxt = goto[node].get(char)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][char] = nxt
+                    goto.append({})
+                    out.append(set())
+                node = nxt
+            out[node].add(pattern)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for node in queue: # breadth first, the queue grows while iterating
+            for char, nxt in goto[node].items():
+                queue.append(nxt)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[nxt] = goto[state].get(char, 0)
+                if fail[nxt] == nxt:
+                    fail[nxt] = 0
+                out[nxt] |= out[fail[nxt]]
+
+        self.empty = "" in self.patterns
+        self._known = frozenset(self.patterns)
+        self._goto, self._fail = goto, fail
+        self._out = [tuple(patterns) for patterns in out]
+        self._pending = False
+
+    def search(self, text):
+        """ Return the set of patterns that occur in the text, and the set of
+            patterns that were searched for """
+        with self._lock:
+            if self._pending:
+                self.build()
+            goto, fail, out = self._goto, self._fail, self._out
+            known = self._known
+            found = {""} if self.empty else set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return found, known
+
+
+def register(name, nocase, target):
+    """ Register the target of a contains condition on an item field """
+    with _LOCK:
+        automaton = _AUTOMATA.get((name, nocase))
+        if automaton is None:
+            automaton = _AUTOMATA[(name, nocase)] = Automaton()
+    automaton.add(target)
+
+def rebuild(targets):
+    """ Replace the registered targets by the given (field, nocase, target)
+        targets, removing the targets that are no longer used """
+    fields = {}
+    for name, nocase, target in targets:
+        fields.setdefault((name, nocase), set()).add(target)
+    with _LOCK:
+        for key in list(_AUTOMATA):
+            if key not in fields:
+                del _AUTOMATA[key]
+        automata = [(_AUTOMATA.setdefault(key, Automaton()), patterns)
+                    for key, patterns in fields.items()]
+    for automaton, patterns in automata:
+        automaton.replace(patterns)
+
+def scan(item):
+    """ Scan the item fields once, returns a dict of (field, nocase) to the
+        (found, searched) targets """
+    with _LOCK:
+        automata = list(_AUTOMATA.items())
+    found = {}
+    for (name, nocase), automaton in automata:
+        if isinstance(item.get(name), str):
+            text = item[name].casefold() if nocase else item[name]
+            found[(name, nocase)] = automaton.search(text)
+    return found
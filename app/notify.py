@@ -0,0 +1,110 @@
+"""
+IFTTT realtime notifications
+
+The bunq callbacks hand the matched trigger identities to a background
+dispatcher instead of calling IFTTT themselves. The dispatcher waits a short
+window for more identities, so callbacks arriving close together result in
+a single notification with one batched data array. Notifications are sent
+over the keep-alive IFTTT session and retried with exponential backoff when
+IFTTT cannot be reached or returns a server error. Every tenant connects its
+own IFTTT service, so the identities are batched per tenant and sent with
+the service key of that tenant.
+"""
+# pylint: disable=broad-except,global-statement
+
+import json
+import queue
+import threading
+import time
+import uuid
+
+import log
+import util
+
+LOG = log.get_logger("notify")
+
+# Seconds to wait for more trigger identities before notifying IFTTT
+WINDOW = 0.2
+
+# Maximum number of trigger identities in one notification
+MAX_BATCH = 100
+
+# Attempts per notification, with the delay doubling after each failure
+ATTEMPTS = 5
+BACKOFF = 0.5
+
+# Timeout per request to IFTTT, in seconds
+TIMEOUT = 10
+
+_QUEUE = queue.Queue()
+_THREAD = None
+_LOCK = threading.Lock()
+
+
+def send(triggerids, tenantid=None):
+    """ Queue notifications for the given trigger identities of a tenant """
+    global _THREAD
+    if not triggerids:
+        return
+    for triggerid in triggerids:
+        _QUEUE.put((tenantid, triggerid))
+    with _LOCK:
+        if _THREAD is None or not _THREAD.is_alive():
+            _THREAD = threading.Thread(target=dispatcher, daemon=True,
+                                       name="ifttt-notify")
+            _THREAD.start()
+
+def dispatcher():
+    """ Collect trigger identities and notify IFTTT in batches """
+    while True:
+        triggerids = [_QUEUE.get()]
+        deadline = time.monotonic() + WINDOW
+        while len(triggerids) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                triggerids.append(_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+        tenants = {}
+        for tenantid, triggerid in dict.fromkeys(triggerids):
+            tenants.setdefault(tenantid, []).append(triggerid)
+        for tenantid, identities in tenants.items():
+            try:
+                notify(identities, tenantid)
+            except Exception:
+                LOG.exception("[notify] error during notification")
+
+def notify(triggerids, tenantid=None):
+    """ Send one notification for the trigger identities of a tenant, with
+        retries """
+    data = json.dumps({"data": [{"trigger_identity": triggerid}
+                                for triggerid in triggerids]})
+    key = util.get_ifttt_tenant_key(tenantid)
+    if key is None:
+        LOG.error("[notify] no IFTTT service key for tenant %s", tenantid)
+        return False
+    headers = {
+        "IFTTT-Channel-Key": key,
+        "IFTTT-Service-Key": key,
+        "X-Request-ID": uuid.uuid4().hex,
+        "Content-Type": "application/json"
+    }
+    LOG.info("[notify] to ifttt: %s", data)
+    delay = BACKOFF
+    for attempt in range(1, ATTEMPTS + 1):
+        try:
+            res = util.get_ifttt_session().post(
+                util.IFTTT_REALTIME + "v1/notifications",
+                headers=headers, data=data, timeout=TIMEOUT)
+            LOG.info("[notify] result: %s %s", res.status_code, res.text)
+            if res.status_code != 429 and res.status_code < 500:
+                return res.status_code < 400
+        except Exception as exc:
+            LOG.warning("[notify] attempt %d failed: %s", attempt, exc)
+        if attempt < ATTEMPTS:
+            time.sleep(delay)
+            delay *= 2
+    LOG.error("[notify] giving up on %s", data)
+    return False
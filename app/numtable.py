@@ -0,0 +1,87 @@
+"""
+Numeric trigger table
+
+Optional NumPy-backed evaluation of the numeric conditions of a large set of
+triggers. The comparator codes and thresholds of the amount and balance
+conditions are stored as arrays, so the numeric conditions of all triggers
+are evaluated in one vectorized pass per event. Only the triggers that pass
+are then checked with their full predicate.
+
+NumPy is optional: when it is not installed, available() returns False and
+the trigger index falls back to its sorted threshold lists.
+"""
+# pylint: disable=global-statement,import-outside-toplevel
+
+import predicate
+
+# Use the vectorized evaluation from this number of triggers onwards
+MIN_TRIGGERS = 500
+
+# Comparator codes, 0 means the condition is not checked in the vector pass
+# (absent, ignore, or a json array comparator that is left to the predicate)
+CODES = {
+    "equal": 1,
+    "not_equal": 2,
+    "above": 3,
+    "above_equal": 4,
+    "below": 5,
+    "below_equal": 6,
+}
+
+_NUMPY = None
+
+
+def numpy():
+    """ Return the numpy module, or None if it is not installed """
+    global _NUMPY
+    if _NUMPY is None:
+        try:
+            import numpy as np
+            _NUMPY = np
+        except ImportError:
+            _NUMPY = False
+    return _NUMPY or None
+
+def available(count):
+    """ Return whether a table should be used for the number of triggers """
+    return count >= MIN_TRIGGERS and numpy() is not None
+
+
+class NumericTable:
+    """ Comparator codes and thresholds of the numeric trigger conditions """
+
+    def __init__(self, fieldslist):
+        np = numpy()
+        columns = predicate.NUMERIC_FIELDS
+        self.names = [name for _, _, name in columns]
+        self.codes = np.zeros((len(fieldslist), len(columns)), dtype=np.int8)
+        self.thresholds = np.zeros((len(fieldslist), len(columns)))
+        for row, fields in enumerate(fieldslist):
+            for col, (comp, value, _) in enumerate(columns):
+                if comp in fields and fields[comp] in CODES:
+                    self.codes[row, col] = CODES[fields[comp]]
+                    self.thresholds[row, col] = float(fields[value])
+
+    def evaluate(self, item):
+        """ Return a boolean array of the triggers passing the numeric
+            conditions for the item """
+        np = numpy()
+        result = np.ones(len(self.codes), dtype=bool)
+        for col, name in enumerate(self.names):
+            if name not in item:
+                continue # left to the predicate
+            try:
+                value = float(item[name])
+            except ValueError:
+                continue
+            codes = self.codes[:, col]
+            thrs = self.thresholds[:, col]
+            passed = codes == 0
+            passed |= (codes == 1) & (value == thrs)
+            passed |= (codes == 2) & (value != thrs)
+            passed |= (codes == 3) & (value > thrs)
+            passed |= (codes == 4) & (value >= thrs)
+            passed |= (codes == 5) & (value < thrs)
+            passed |= (codes == 6) & (value <= thrs)
+            result &= passed
+        return result
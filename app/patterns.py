@@ -0,0 +1,63 @@
+"""
+Regular expression patterns
+
+Compiled patterns for the regex and regex_nc comparators, kept in a bounded
+LRU cache so a pattern is compiled once and not on every event.
+
+Each search is limited in time, using the timeout of the regex package (the
+standard re module cannot interrupt a search). A pattern that exceeds the
+limit MAX_TIMEOUTS times is disabled and no longer matches anything.
+"""
+# pylint: disable=import-outside-toplevel
+
+import functools
+
+import log
+
+LOG = log.get_logger("patterns")
+
+# Maximum number of compiled patterns kept in memory
+CACHE_SIZE = 1000
+
+# Time limit per search, in seconds
+TIME_LIMIT = 0.05
+
+# Number of searches over the time limit after which a pattern is disabled
+MAX_TIMEOUTS = 3
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def get_pattern(pattern, nocase):
+    """ Return the compiled pattern, raises an error for invalid patterns """
+    return Pattern(pattern, nocase)
+
+
+class Pattern:
+    """ A compiled pattern with a time limit per search """
+
+    def __init__(self, pattern, nocase):
+        self.pattern = pattern
+        self.timeouts = 0
+        import regex
+        flags = regex.IGNORECASE | regex.VERSION0 if nocase \
+                else regex.VERSION0
+        self.compiled = regex.compile(pattern, flags)
+
+    def search(self, text):
+        """ Return whether the pattern occurs in the text """
+        if self.timeouts >= MAX_TIMEOUTS:
+            return False
+        try:
+            return self.compiled.search(text, timeout=TIME_LIMIT) is not None
+        except TimeoutError:
+            self.timed_out()
+            return False
+
+    def timed_out(self):
+        """ Count a search over the time limit """
+        self.timeouts += 1
+        LOG.warning("[patterns] search for %s over the time limit (%d times)",
+                    log.Json(self.pattern), self.timeouts)
+        if self.timeouts >= MAX_TIMEOUTS:
+            LOG.warning("[patterns] disabled %s", log.Json(self.pattern))
+
@@ -10,8 +10,11 @@ import uuid
 from flask import request
 
 import bunq
+import log
 import util
 
+LOG = log.get_logger("payment")
+
 
 def create_payment_message(internal, fields, config):
     """ Get the payment message """
@@ -24,7 +27,7 @@ def create_payment_message(internal, fields, config):
     for field in expected_fields:
         if field not in fields:
             errmsg = "missing field: "+field
-            print("[action_payment] ERROR: "+errmsg)
+            LOG.error("[action_payment] %s", errmsg)
             return {"errors": [{"status": "SKIP", "message": errmsg}]}
 
     # strip spaces from account numbers
@@ -38,7 +41,7 @@ def create_payment_message(internal, fields, config):
         amount = -1
     if amount <= 0:
         errmsg = "only positive amounts allowed: "+fields["amount"]
-        print("[action_payment] ERROR: "+errmsg)
+        LOG.error("[action_payment] %s", errmsg)
         return {"errors": [{"status": "SKIP", "message": errmsg}]}
 
     # the account NL42BUNQ0123456789 is used for test payments
@@ -53,7 +56,7 @@ def create_payment_message(internal, fields, config):
                 target_name = acc["name"]
         if target_name is None:
             errmsg = "unknown target account: "+fields["target_account"]
-            print("[action_payment] ERROR: "+errmsg)
+            LOG.error("[action_payment] %s", errmsg)
             return {"errors": [{"status": "SKIP", "message": errmsg}]}
     else:
         target_name = fields["target_name"]
@@ -71,7 +74,7 @@ def create_payment_message(internal, fields, config):
         },
         "description": fields["description"]
     }
-    print(payment)
+    log.payload(LOG, "[action_payment] payment", payment)
     return payment
 
 
@@ -96,9 +99,8 @@ def check_source_account(internal, draft, config, iban):
 
 def ifttt_bunq_payment(internal, draft):
     """ Execute a draft, internal or external payment """
-    config = bunq.retrieve_config()
     data = request.get_json()
-    print("[action_payment] input: {}".format(json.dumps(data)))
+    log.payload(LOG, "[action_payment] input", data)
 
     errmsg = None
     if not internal and not draft and not util.get_external_payment_enabled():
@@ -107,12 +109,13 @@ def ifttt_bunq_payment(internal, draft):
         errmsg = "missing actionFields"
 
     if errmsg:
-        print("[action_payment] ERROR: "+errmsg)
+        LOG.error("[action_payment] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
     # get the payment message
     fields = data["actionFields"]
+    config = util.get_ifttt_config()
     msg = create_payment_message(internal, fields, config)
     if "errors" in msg or "data" in msg: # error or test payment
         return json.dumps(msg), 400 if "errors" in msg else 200
@@ -127,7 +130,7 @@ def ifttt_bunq_payment(internal, draft):
                  fields["source_account"]
 
     if errmsg:
-        print("[action_payment] ERROR: "+errmsg)
+        LOG.error("[action_payment] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -135,12 +138,15 @@ def ifttt_bunq_payment(internal, draft):
     if draft:
         msg = {"number_of_required_accepts": 1, "entries": [msg]}
         result = bunq.post("v1/user/{}/monetary-account/{}/draft-payment"
-                           .format(config["user_id"], source_accid), msg)
+                           .format(config["user_id"], source_accid), msg,
+                           config)
     else:
         result = bunq.post("v1/user/{}/monetary-account/{}/payment"
-                           .format(config["user_id"], source_accid), msg)
-    print(result)
+                           .format(config["user_id"], source_accid), msg,
+                           config)
+    log.payload(LOG, "[action_payment] result", result)
     if "Error" in result:
+        LOG.warning("[action_payment] bunq error: %s", log.Json(result))
         return json.dumps({"errors": [{
             "status": "SKIP",
             "message": result["Error"][0]["error_description"]
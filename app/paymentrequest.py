@@ -11,12 +11,15 @@ from flask import request
 
 import util
 import bunq
+import log
+
+LOG = log.get_logger("paymentrequest")
 
 
 def request_inquiry():
     """ Execute a request inquiry action """
     data = request.get_json()
-    print("[request_inquiry] input: {}".format(json.dumps(data)))
+    log.payload(LOG, "[request_inquiry] input", data)
 
     errmsg = None
     if "actionFields" not in data:
@@ -29,7 +32,7 @@ def request_inquiry():
                 errmsg = "missing field: "+field
 
     if errmsg:
-        print("[request_inquiry] ERROR: "+errmsg)
+        LOG.error("[request_inquiry] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -39,13 +42,14 @@ def request_inquiry():
     if fields["account"] == "NL42BUNQ0123456789":
         return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
 
+    config = util.get_ifttt_config()
     accountid = None
-    for acc in util.get_bunq_accounts("PaymentRequest"):
+    for acc in util.get_bunq_accounts("PaymentRequest", config):
         if acc["iban"] == fields["account"]:
             accountid = acc["id"]
     if accountid is None:
         errmsg = "unknown account: "+fields["account"]
-        print("[request_inquiry] ERROR: "+errmsg)
+        LOG.error("[request_inquiry] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -56,7 +60,7 @@ def request_inquiry():
         amount = -1
     if amount <= 0:
         errmsg = "only positive amounts allowed: "+fields["amount"]
-        print("[action_payment] ERROR: "+errmsg)
+        LOG.error("[action_payment] %s", errmsg)
         return {"errors": [{"status": "SKIP", "message": errmsg}]}
 
     # check phone or email
@@ -69,7 +73,7 @@ def request_inquiry():
         bmtype = "IBAN"
     else:
         errmsg = "Unrecognized as email, phone or iban: "+bmvalue
-        print("[request_inquiry] ERROR: "+errmsg)
+        LOG.error("[request_inquiry] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -87,13 +91,13 @@ def request_inquiry():
         "description": description,
         "allow_bunqme": True,
     }
-    print(json.dumps(msg))
+    log.payload(LOG, "[request_inquiry] request", msg)
 
-    config = bunq.retrieve_config()
     data = bunq.post("v1/user/{}/monetary-account/{}/request-inquiry".format(\
                      config["user_id"], accountid), msg, config)
-    print(data)
+    log.payload(LOG, "[request_inquiry] result", data)
     if "Error" in data:
+        LOG.warning("[request_inquiry] bunq error: %s", log.Json(data))
         return json.dumps({"errors": [{
             "status": "SKIP",
             "message": data["Error"][0]["error_description"]
@@ -0,0 +1,59 @@
+"""
+Poll cache
+
+IFTTT polls every trigger regularly, mostly without anything having changed.
+The serialized response of a poll is kept in memory per trigger identity,
+timezone and limit, together with the trigger fields and the event ids of
+the history it was built from. A poll with the same fields and history is
+answered from the cache, without storing the trigger or reading the events.
+
+Responses carry an ETag, so a client that sends If-None-Match with the
+current tag gets a 304 without a body.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Maximum number of trigger identities kept in the cache
+CACHE_SIZE = 10000
+
+_CACHE = OrderedDict()
+_LOCK = threading.Lock()
+
+
+def get(kind, identity, fieldsstr, history, timezone, limit):
+    """ Return the cached (body, etag) of a poll, or None if not cached or
+        if the fields or history changed """
+    with _LOCK:
+        entry = _CACHE.get((kind, identity))
+        if entry is None or entry["fields"] != fieldsstr \
+                or entry["history"] != history:
+            return None
+        _CACHE.move_to_end((kind, identity))
+        return entry["responses"].get((timezone, limit))
+
+def put(kind, identity, fieldsstr, history, timezone, limit, body):
+    """ Cache the response of a poll, returns (body, etag) """
+    body, etag = tag(body)
+    with _LOCK:
+        entry = _CACHE.get((kind, identity))
+        if entry is None or entry["fields"] != fieldsstr \
+                or entry["history"] != history:
+            entry = {"fields": fieldsstr, "history": list(history),
+                     "responses": {}}
+            _CACHE[(kind, identity)] = entry
+        entry["responses"][(timezone, limit)] = (body, etag)
+        _CACHE.move_to_end((kind, identity))
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    return body, etag
+
+def tag(body):
+    """ Return (body, etag) for a response """
+    return body, '"{}"'.format(hashlib.sha1(body.encode("utf-8")).hexdigest())
+
+def invalidate(kind, identity):
+    """ Remove the cached responses of a trigger identity """
+    with _LOCK:
+        _CACHE.pop((kind, identity), None)
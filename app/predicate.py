@@ -0,0 +1,296 @@
+"""
+Trigger predicates
+
+Compiles the conditional fields of a trigger once into a predicate, with the
+numeric targets parsed, the case-insensitive targets casefolded, the json
+arrays loaded into sets and the regular expressions taken from the pattern
+cache (see the patterns module). Matching an event against a trigger is then
+a series of in-memory comparisons. The targets of "contains" conditions are
+registered with the multimatch module, so they can be answered from one scan
+per event.
+
+Predicates are cached by a hash of the trigger fields, so they are only
+rebuilt when the fields of a trigger change. Each predicate counts how often
+its conditions pass, and periodically reorders them so that the cheapest and
+most selective conditions run first. Evaluation stops at the first condition
+that fails. The learned order is printed whenever it changes.
+"""
+# pylint: disable=broad-except
+
+import hashlib
+import json
+import operator
+import threading
+from collections import OrderedDict
+
+import log
+import multimatch
+import patterns
+
+LOG = log.get_logger("predicate")
+
+# Maximum number of compiled predicates kept in memory
+CACHE_SIZE = 10000
+
+# Conditions are reordered every this many evaluations of a predicate, based
+# on pass rates observed over at least MIN_SAMPLES evaluations
+REORDER_INTERVAL = 1000
+MIN_SAMPLES = 100
+
+# Relative cost estimates of the condition kinds
+COST_NUM = 1
+COST_SCAN = 1
+COST_STR = 2
+COST_REGEX = 5
+
+_CACHE = OrderedDict()
+_LOCK = threading.Lock()
+
+# (comparator field, value field, item field) in the order they are checked
+NUMERIC_FIELDS = [
+    ("amount_comparator", "amount_value", "amount"),
+    ("amount_comparator_2", "amount_value_2", "amount"),
+    ("balance_comparator", "balance_value", "balance"),
+    ("balance_comparator_2", "balance_value_2", "balance"),
+]
+ALPHA_FIELDS = [
+    ("counterparty_name_comparator", "counterparty_name_value",
+     "counterparty_name"),
+    ("counterparty_name_comparator_2", "counterparty_name_value_2",
+     "counterparty_name"),
+    ("counterparty_account_comparator", "counterparty_account_value",
+     "counterparty_account"),
+    ("counterparty_account_comparator_2", "counterparty_account_value_2",
+     "counterparty_account"),
+    ("description_comparator", "description_value", "description"),
+    ("description_comparator_2", "description_value_2", "description"),
+]
+TYPE_FIELDS = ["type_2", "type_3", "type_4"]
+
+_NUMERIC_OPERATORS = {
+    "equal": operator.eq,
+    "not_equal": operator.ne,
+    "above": operator.gt,
+    "above_equal": operator.ge,
+    "below": operator.lt,
+    "below_equal": operator.le,
+}
+_NOCASE = ["equal_nc", "not_equal_nc", "cont_nc", "not_cont_nc", "in_nc",
+           "not_in_nc"]
+_CONTAINS = ["cont", "cont_nc", "not_cont", "not_cont_nc"]
+_REGEX = ["regex", "regex_nc"]
+
+
+def fields_hash(fields):
+    """ Return a hash of the canonical representation of trigger fields """
+    return hashlib.sha1(json.dumps(fields, sort_keys=True)
+                        .encode("utf-8")).hexdigest()
+
+def get_predicate(fields, key=None):
+    """ Return the compiled predicate for the given trigger fields, key is
+        the fields_hash of the fields if already known """
+    if key is None:
+        key = fields_hash(fields)
+    with _LOCK:
+        pred = _CACHE.get(key)
+        if pred is not None:
+            _CACHE.move_to_end(key)
+            return pred
+    pred = Predicate(fields, key)
+    with _LOCK:
+        _CACHE[key] = pred
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    return pred
+
+
+class Condition:
+    """ A single condition of a predicate, with its observed pass rate """
+    __slots__ = ["label", "test", "cost", "evaluated", "passed"]
+
+    def __init__(self, label, test, cost):
+        self.label = label
+        self.test = test
+        self.cost = cost
+        self.evaluated = 0
+        self.passed = 0
+
+    def rank(self):
+        """ Expected cost per rejected event, lower runs first """
+        if self.evaluated < MIN_SAMPLES:
+            return self.cost
+        failed = (self.evaluated - self.passed) / self.evaluated
+        return self.cost / max(failed, 0.001)
+
+    def describe(self):
+        """ Return the label and observed pass rate, for debug output """
+        if not self.evaluated:
+            return "{} (-)".format(self.label)
+        return "{} ({:.0%} of {})".format(self.label,
+                                          self.passed / self.evaluated,
+                                          self.evaluated)
+
+
+class Predicate:
+    """ The compiled conditions of a trigger """
+
+    def __init__(self, fields, key=None):
+        self.key = key
+        self.types = None
+        self.conditions = []
+        self.targets = [] # (field, nocase, target) of the contains conditions
+        self.error = None
+        self.evaluations = 0
+        try:
+            self.types = compile_types(fields)
+            if self.types is not None:
+                self.add("type", compile_type_test(self.types), COST_NUM)
+            for comp, value, name in NUMERIC_FIELDS:
+                if comp in fields:
+                    self.add("{} {}".format(name, fields[comp]),
+                             compile_num(name, fields[comp], fields[value]),
+                             COST_NUM)
+            for comp, value, name in ALPHA_FIELDS:
+                if comp in fields and fields[comp] in _CONTAINS:
+                    self.targets.append(contains_target(name, fields[comp],
+                                                        fields[value]))
+                    self.add("{} {}".format(name, fields[comp]),
+                             compile_substring(name, fields[comp],
+                                               fields[value]), COST_SCAN)
+                elif comp in fields and fields[comp] in _REGEX:
+                    self.add("{} {}".format(name, fields[comp]),
+                             compile_regex(name, fields[comp], fields[value]),
+                             COST_REGEX)
+                elif comp in fields:
+                    self.add("{} {}".format(name, fields[comp]),
+                             compile_str(name, fields[comp], fields[value]),
+                             COST_STR)
+        except Exception as exc:
+            LOG.exception("[predicate] error compiling trigger fields %s",
+                          log.Json(fields))
+            self.error = exc
+
+    def add(self, label, test, cost):
+        """ Add a condition, a test of None means it is always true """
+        if test is not None:
+            self.conditions.append(Condition(label, test, cost))
+
+    def matches(self, item, found=None):
+        """ Return whether the item satisfies all conditions, using the
+            result of multimatch.scan for the contains conditions if given """
+        if self.error is not None:
+            return False
+        self.evaluations += 1
+        if self.evaluations % REORDER_INTERVAL == 0:
+            self.reorder()
+        for condition in self.conditions:
+            condition.evaluated += 1
+            if not condition.test(item, found):
+                return False
+            condition.passed += 1
+        return True
+
+    def reorder(self):
+        """ Run the cheapest and most selective conditions first """
+        ordered = sorted(self.conditions, key=Condition.rank)
+        if ordered != self.conditions:
+            self.conditions = ordered
+            LOG.info("[predicate] %s order: %s", self.key, self.describe())
+
+    def describe(self):
+        """ Return the current order of the conditions, for debug output """
+        return ", ".join([cond.describe() for cond in self.conditions])
+
+
+def compile_types(fields):
+    """ Return the tuple of accepted type prefixes, or None for any type """
+    if "type" not in fields or fields["type"] == "ANY":
+        return None
+    types = [fields["type"]]
+    for field in TYPE_FIELDS:
+        if field in fields and fields[field] != "---":
+            types.append(fields[field])
+    return tuple(types)
+
+def compile_type_test(types):
+    """ Compile the condition on the mutation type """
+    return lambda item, _: item["type"].startswith(types)
+
+def compile_num(name, comparator, target):
+    """ Compile a condition on a numeric field """
+    if comparator == "ignore":
+        return None
+    if comparator in _NUMERIC_OPERATORS:
+        oper = _NUMERIC_OPERATORS[comparator]
+        value = float(target)
+        return lambda item, _: oper(float(item[name]), value)
+    if comparator == "in":
+        values = load_values(target)
+        return lambda item, _: item[name] in values
+    if comparator == "not_in":
+        values = load_values(target)
+        return lambda item, _: item[name] not in values
+    return never
+
+def compile_str(name, comparator, target):
+    """ Compile a condition on a string field """
+    if comparator == "ignore":
+        return None
+    if comparator in _NOCASE:
+        target = target.casefold()
+        orig = lambda item: item[name].casefold()
+    else:
+        orig = lambda item: item[name]
+    if comparator in ["equal", "equal_nc"]:
+        return lambda item, _: orig(item) == target
+    if comparator in ["not_equal", "not_equal_nc"]:
+        return lambda item, _: orig(item) != target
+    if comparator in ["in", "in_nc"]:
+        values = load_values(target)
+        return lambda item, _: orig(item) in values
+    if comparator in ["not_in", "not_in_nc"]:
+        values = load_values(target)
+        return lambda item, _: orig(item) not in values
+    return never
+
+def contains_target(name, comparator, target):
+    """ Return the (field, nocase, target) searched for by a contains
+        condition """
+    nocase = comparator in _NOCASE
+    return name, nocase, target.casefold() if nocase else target
+
+def compile_substring(name, comparator, target):
+    """ Compile a contains condition, answered by the multimatch scan """
+    name, nocase, target = contains_target(name, comparator, target)
+    negate = comparator.startswith("not_")
+    multimatch.register(name, nocase, target)
+    key = (name, nocase)
+
+    def test(item, found):
+        """ Check the result of the scan, or search the field directly """
+        if found is not None and key in found and target in found[key][1]:
+            present = target in found[key][0]
+        else:
+            orig = item[name].casefold() if nocase else item[name]
+            present = target in orig
+        return present != negate
+    return test
+
+def compile_regex(name, comparator, target):
+    """ Compile a regular expression condition, using the pattern cache """
+    pattern = patterns.get_pattern(target, comparator == "regex_nc")
+    return lambda item, _: pattern.search(item[name])
+
+def load_values(target):
+    """ Load a json array into a set, keeping other json values as is """
+    values = json.loads(target)
+    if isinstance(values, list):
+        try:
+            return frozenset(values)
+        except TypeError: # unhashable elements, e.g. nested arrays
+            pass
+    return values
+
+def never(*_):
+    """ Condition for unknown comparators """
+    return False
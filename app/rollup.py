@@ -0,0 +1,167 @@
+"""
+Rollups and IFTTT queries
+
+Keeps daily totals of the mutations of each account, maintained in the
+mutation callback path, to answer IFTTT queries without reading events.
+Each account has a single record in the rollup kind (per tenant) holding:
+- days: per date the amount spent and received (in cents) and the number
+  of mutations, for the last DAYS days
+- months: per month and counterparty name the same totals, for the last
+  MONTHS months
+
+Every event updates the record of its account, and a query is answered from
+one read of that record. The queries are:
+- bunq_daily_totals: the totals per day over the last number of days
+- bunq_top_counterparties: the counterparties of this or last month with
+  the highest amount spent
+"""
+# pylint: disable=broad-except
+
+import datetime
+import json
+import threading
+
+from flask import request
+
+import aggregate
+import log
+import storage
+import tenant
+import util
+
+LOG = log.get_logger("rollup")
+
+# Number of days and months kept
+DAYS = 62
+MONTHS = 2
+
+_LOCK = threading.Lock()
+
+
+def add(tenantid, item):
+    """ Add a mutation event to the rollup of its account """
+    amount = aggregate.cents(item["amount"])
+    add_totals = [max(-amount, 0), max(amount, 0), 1]
+    kind = tenant.kind("rollup", tenantid)
+    with _LOCK:
+        record = storage.get_value(kind, item["account"])
+        if record is None:
+            record = {"days": {}, "months": {}, "recent": []}
+        if not aggregate.add_recent(record, item["meta"]["id"]):
+            return
+
+        month = item["date"][:7]
+        totals = [record["days"].setdefault(item["date"], [0, 0, 0]),
+                  record["months"].setdefault(month, {}).setdefault(
+                      item["counterparty_name"], [0, 0, 0])]
+        for total in totals:
+            for num in range(3):
+                total[num] += add_totals[num]
+
+        cutoff = (datetime.date.fromisoformat(max(record["days"])) -
+                  datetime.timedelta(days=DAYS)).isoformat()
+        for date in [date for date in record["days"] if date <= cutoff]:
+            del record["days"][date]
+        for month in sorted(record["months"])[:-MONTHS]:
+            del record["months"][month]
+        storage.store_large(kind, item["account"], record)
+
+def get(account):
+    """ Return the rollup record of an account of the tenant of the IFTTT
+        request """
+    record = storage.get_value(tenant.kind("rollup", util.ifttt_tenant()),
+                               account)
+    if record is None:
+        record = {"days": {}, "months": {}}
+    return record
+
+def totals_json(total):
+    """ Return the ingredients of a [spent, received, count] total """
+    return {
+        "spent": "{:.2f}".format(total[0] / 100),
+        "received": "{:.2f}".format(total[1] / 100),
+        "count": total[2],
+    }
+
+
+###############################################################################
+# IFTTT query bunq_daily_totals
+###############################################################################
+
+def query_daily_totals():
+    """ Return the totals per day of an account, newest first """
+    try:
+        data = request.get_json()
+        log.payload(LOG, "[query_daily_totals] input", data)
+        fields, limit, errmsg = check_query(data)
+        if errmsg:
+            LOG.error("[query_daily_totals] %s", errmsg)
+            return json.dumps({"errors": [{"message": errmsg}]}), 400
+
+        days = min(int(fields.get("days", 30)), DAYS)
+        record = get(fields["account"])
+        today = datetime.datetime.utcnow().date()
+        result = []
+        for num in range(days):
+            date = (today - datetime.timedelta(days=num)).isoformat()
+            entry = {"date": date}
+            entry.update(totals_json(record["days"].get(date, [0, 0, 0])))
+            result.append(entry)
+        return json.dumps({"data": result[:limit]})
+    except Exception:
+        LOG.exception("[query_daily_totals] cannot retrieve totals")
+        return json.dumps({"errors": [{"message": \
+                           "Cannot retrieve totals"}]}), 400
+
+
+###############################################################################
+# IFTTT query bunq_top_counterparties
+###############################################################################
+
+def query_top_counterparties():
+    """ Return the counterparties of a month by amount spent """
+    try:
+        data = request.get_json()
+        log.payload(LOG, "[query_top_counterparties] input", data)
+        fields, limit, errmsg = check_query(data)
+        if errmsg:
+            LOG.error("[query_top_counterparties] %s", errmsg)
+            return json.dumps({"errors": [{"message": errmsg}]}), 400
+
+        month = datetime.datetime.utcnow().date().replace(day=1)
+        if fields.get("month") == "last":
+            month = (month - datetime.timedelta(days=1)).replace(day=1)
+        if fields["account"] == "NL42BUNQ0123456789":
+            record = {"months": {month.isoformat()[:7]: {
+                "ACME Store Inc.": [10101, 0, 3],
+                "John Doe": [2020, 5050, 2],
+            }}}
+        else:
+            record = get(fields["account"])
+        counterparties = record["months"].get(month.isoformat()[:7], {})
+        result = []
+        for name, total in sorted(counterparties.items(),
+                                  key=lambda entry: (-entry[1][0],
+                                                     -entry[1][2])):
+            entry = {"counterparty_name": name, "month": month.isoformat()[:7]}
+            entry.update(totals_json(total))
+            result.append(entry)
+        return json.dumps({"data": result[:limit]})
+    except Exception:
+        LOG.exception("[query_top_counterparties] cannot retrieve totals")
+        return json.dumps({"errors": [{"message": \
+                           "Cannot retrieve totals"}]}), 400
+
+
+def check_query(data):
+    """ Check the fields of a query, returns (fields, limit, errmsg) """
+    if "queryFields" not in data or "account" not in data["queryFields"]:
+        return None, None, "missing account field"
+    fields = data["queryFields"]
+    limit = data.get("limit", 50)
+    config = util.get_ifttt_config()
+    if fields["account"] != "NL42BUNQ0123456789" and \
+            not util.check_valid_bunq_account(fields["account"], "Mutation",
+                                              config)[0]:
+        return None, None, "account not enabled for queries"
+    return fields, limit, None
@@ -7,29 +7,49 @@ it will select:
 - Local storage in the db/ directory
 """
 
+# pylint: disable=global-statement,import-outside-toplevel
+
 import json
 import os
 import threading
 import time
-import traceback
 
-if os.getenv("GAE_INSTANCE") is not None:
-    # Used in Google Appengine, so use Google datastore
-    from google.cloud import datastore
-    DSCLIENT = datastore.Client()
-    USE_GOOGLE_DATASTORE = True
-else:
-    # Use local datastore
-    USE_GOOGLE_DATASTORE = False
+import log
+
+LOG = log.get_logger("storage")
+
+# Used in Google Appengine, so use Google datastore, else use local datastore
+USE_GOOGLE_DATASTORE = os.getenv("GAE_INSTANCE") is not None
 
 LOCK = threading.Lock()
 
+# The datastore client is created on first use, as importing the google cloud
+# libraries and creating the client are slow and would delay the cold start
+_DSCLIENT = None
+_DSLOCK = threading.Lock()
+
+
+def dsclient():
+    """ Return the Google datastore client, create it if needed """
+    global _DSCLIENT
+    if _DSCLIENT is None:
+        with _DSLOCK:
+            if _DSCLIENT is None:
+                from google.cloud import datastore
+                _DSCLIENT = datastore.Client()
+    return _DSCLIENT
+
+def dsentity(key, exclude_from_indexes=()):
+    """ Return a new Google datastore entity """
+    from google.cloud import datastore
+    return datastore.Entity(key=key, exclude_from_indexes=exclude_from_indexes)
+
 
 def query_indexes(kind):
     """ Query all indexes for the given kind """
     if USE_GOOGLE_DATASTORE:
         result = []
-        qry = DSCLIENT.query(kind=kind)
+        qry = dsclient().query(kind=kind)
         qry.keys_only()
         for entity in qry.fetch():
             result.append(entity.key.id_or_name)
@@ -45,7 +65,7 @@ def query_all(kind):
     """ Query all stored data of the given kind """
     result = []
     if USE_GOOGLE_DATASTORE:
-        qry = DSCLIENT.query(kind=kind)
+        qry = dsclient().query(kind=kind)
         for entity in qry.fetch():
             data = {'id': entity.key.id_or_name}
             for key in entity.keys():
@@ -65,11 +85,30 @@ def query_all(kind):
     return result
 
 
+def query_range(kind, start, end, limit=None):
+    """ Query the indexes from start (inclusive) to end (exclusive) of the
+        given kind in index order """
+    if USE_GOOGLE_DATASTORE:
+        qry = dsclient().query(kind=kind)
+        qry.keys_only()
+        qry.key_filter(dsclient().key(kind, start), ">=")
+        qry.key_filter(dsclient().key(kind, end), "<")
+        qry.order = ["__key__"]
+        return [entity.key.id_or_name for entity in qry.fetch(limit=limit)]
+    fname = "db" + os.sep + str(kind) + os.sep
+    try:
+        names = os.listdir(fname)
+    except FileNotFoundError:
+        return []
+    result = sorted([name for name in names if start <= name < end])
+    return result if limit is None else result[:limit]
+
+
 def query(kind, label, comparator, value):
     """ Query stored data and return all that satisfy the given condition """
     result = []
     if USE_GOOGLE_DATASTORE:
-        qry = DSCLIENT.query(kind=kind)
+        qry = dsclient().query(kind=kind)
         qry.add_filter(label, comparator, json.dumps(value))
         for entity in qry.fetch():
             data = {'id': entity.key.id_or_name}
@@ -86,6 +125,8 @@ def query(kind, label, comparator, value):
             with open(base + fname) as fil:
                 data = json.loads(fil.read())
                 data['id'] = fname
+            if label not in data: # same as datastore: skip unset properties
+                continue
             if comparator == "=" and data[label] == value:
                 result.append(data)
             elif comparator == "<" and data[label] < value:
@@ -103,8 +144,8 @@ def retrieve(kind, index):
     """ Retrieve a previously stored dict """
     index = str(index)
     if USE_GOOGLE_DATASTORE:
-        key = DSCLIENT.key(kind, index)
-        entity = DSCLIENT.get(key)
+        key = dsclient().key(kind, index)
+        entity = dsclient().get(key)
         if entity is None:
             return None
         result = {}
@@ -119,6 +160,21 @@ def retrieve(kind, index):
     return None
 
 
+def retrieve_multi(kind, indexes):
+    """ Retrieve multiple previously stored dicts in one batch, returns a
+        list in the order of the indexes with None for missing records """
+    indexes = [str(index) for index in indexes]
+    if USE_GOOGLE_DATASTORE:
+        keys = [dsclient().key(kind, index)
+                for index in dict.fromkeys(indexes)]
+        found = {}
+        for entity in dsclient().get_multi(keys):
+            found[entity.key.id_or_name] = {label: json.loads(entity[label])
+                                            for label in entity.keys()}
+        return [found.get(index) for index in indexes]
+    return [retrieve(kind, index) for index in indexes]
+
+
 def get_value(kind, index):
     """ Retrieve a previously stored value """
     data = retrieve(kind, index)
@@ -131,10 +187,10 @@ def store(kind, index, value):
     """ Store a dict """
     index = str(index)
     if USE_GOOGLE_DATASTORE:
-        entity = datastore.Entity(key=DSCLIENT.key(kind, index))
+        entity = dsentity(dsclient().key(kind, index))
         for label in value:
             entity[label] = json.dumps(value[label])
-        DSCLIENT.put(entity)
+        dsclient().put(entity)
     else:
         fname = "db" + os.sep + str(kind)
         os.makedirs(fname, exist_ok=True)
@@ -143,20 +199,26 @@ def store(kind, index, value):
             fil.write(json.dumps(value))
 
 
-def store_large(kind, index, value):
-    """ Store a large (not indexed) value """
+def store_large(kind, index, value, timestamp=None):
+    """ Store a large (not indexed) value, with an indexed timestamp for
+        remove_older if given """
     index = str(index)
     if USE_GOOGLE_DATASTORE:
-        entity = datastore.Entity(key=DSCLIENT.key(kind, index),
-                                  exclude_from_indexes=['value'])
+        entity = dsentity(dsclient().key(kind, index),
+                          exclude_from_indexes=['value'])
         entity["value"] = json.dumps(value)
-        DSCLIENT.put(entity)
+        if timestamp is not None:
+            entity["timestamp"] = json.dumps(int(timestamp))
+        dsclient().put(entity)
     else:
         fname = "db" + os.sep + str(kind)
         os.makedirs(fname, exist_ok=True)
         fname += os.sep + str(index)
+        data = {"value": value}
+        if timestamp is not None:
+            data["timestamp"] = int(timestamp)
         with open(fname, "w") as fil:
-            fil.write(json.dumps({"value": value}))
+            fil.write(json.dumps(data))
 
 
 def insert_value_maxsize(kind, index, value, maxsize):
@@ -174,8 +236,8 @@ def remove(kind, index):
     """ Remove the given record """
     index = str(index)
     if USE_GOOGLE_DATASTORE:
-        print("delete: ", kind, index)
-        DSCLIENT.delete(DSCLIENT.key(kind, index))
+        LOG.debug("[storage] delete %s %s", kind, index)
+        dsclient().delete(dsclient().key(kind, index))
     else:
         fname = "db" + os.sep + str(kind) + os.sep + str(index)
         os.remove(fname)
@@ -184,6 +246,44 @@ def remove(kind, index):
         except OSError:
             pass
 
+def remove_multi(kind, indexes):
+    """ Remove the given records in batches, skipping missing records """
+    indexes = [str(index) for index in indexes]
+    if USE_GOOGLE_DATASTORE:
+        LOG.debug("[storage] delete %d from %s", len(indexes), kind)
+        for start in range(0, len(indexes), 500):
+            dsclient().delete_multi([dsclient().key(kind, index)
+                                     for index in indexes[start:start+500]])
+    else:
+        for index in indexes:
+            try:
+                remove(kind, index)
+            except FileNotFoundError:
+                pass
+
+def remove_older(kind, timestamp):
+    """ Remove the records stored with a timestamp before the given one,
+        returns the number of records removed """
+    if USE_GOOGLE_DATASTORE:
+        qry = dsclient().query(kind=kind)
+        qry.add_filter("timestamp", "<", json.dumps(int(timestamp)))
+        qry.keys_only()
+        indexes = [entity.key.id_or_name for entity in qry.fetch()]
+    else:
+        indexes = []
+        base = "db" + os.sep + str(kind) + os.sep
+        try:
+            names = os.listdir(base)
+        except FileNotFoundError:
+            return 0
+        for fname in names:
+            with open(base + fname) as fil:
+                data = json.loads(fil.read())
+            if data.get("timestamp", timestamp) < timestamp:
+                indexes.append(fname)
+    remove_multi(kind, indexes)
+    return len(indexes)
+
 # pylint: disable=bare-except
 def seen(kind, index):
     """ Write a 'seen' object with a transaction/locking to ensure
@@ -199,8 +299,8 @@ def seen(kind, index):
                 result = seen_google(kind, index)
                 break
             except:
-                traceback.print_exc()
-                print("Retries left: ", retries)
+                LOG.exception("[storage] seen failed, retries left: %d",
+                              retries)
     else:
         LOCK.acquire()
         fname = "db" + os.sep + str(kind) + "." + str(index)
@@ -215,25 +315,25 @@ def seen(kind, index):
 
 def seen_google(kind, index):
     """ Helper method for the seen method above, used with google datastore """
-    with DSCLIENT.transaction():
-        seenkey = DSCLIENT.key(kind, index)
-        entity = DSCLIENT.get(seenkey)
+    with dsclient().transaction():
+        seenkey = dsclient().key(kind, index)
+        entity = dsclient().get(seenkey)
         if entity is not None:
             return True
-        entity = datastore.Entity(key=seenkey)
+        entity = dsentity(seenkey)
         entity["timestamp"] = int(time.time())
-        DSCLIENT.put(entity)
+        dsclient().put(entity)
         return False
 
 def clean_seen(kind):
     """ Clean up the seen index by removing all older than 15 minutes """
     target = int(time.time()) - 900
     if USE_GOOGLE_DATASTORE:
-        qry = DSCLIENT.query(kind=kind)
+        qry = dsclient().query(kind=kind)
         qry.add_filter("timestamp", "<", target)
         qry.keys_only()
         for entity in qry.fetch():
-            DSCLIENT.delete(entity.key)
+            dsclient().delete(entity.key)
     else:
         fname = "db" + os.sep + str(kind) + os.sep
         try:
@@ -0,0 +1,87 @@
+"""
+Reconciliation of missed bunq callbacks
+
+Callbacks that bunq could not deliver (instance down, errors) are lost, so
+a cron job regularly compares the payment list of every account against the
+events received. Per account a high-water mark (the id of the newest payment
+synced) is kept in the sync_state kind, and only the payments newer than it
+are listed, following the pagination towards newer payments. The cost of a
+run thus follows the number of new payments, not the length of the account
+history.
+
+Payments that are not in the event store yet are fed through the normal
+callback pipeline, where the seen check filters callbacks that arrive at the
+same time. On the first run for an account, the mark is only set to the
+newest payment; earlier payments are the job of the backfill.
+"""
+# pylint: disable=broad-except
+
+import bunq
+import ingest
+import log
+import storage
+import tenant
+import util
+
+LOG = log.get_logger("sync")
+
+# Number of payments per page and maximum number of pages per account per run
+PAGE_SIZE = 200
+MAX_PAGES = 10
+
+
+def sync_all():
+    """ Sync the accounts of all tenants, returns the number of payments
+        that were missed """
+    missed = 0
+    for tenantid in tenant.all_tenants():
+        config = bunq.retrieve_config(tenantid=tenantid)
+        if "accounts" not in config:
+            continue
+        for acc in util.get_bunq_accounts("Mutation", config):
+            try:
+                missed += sync_account(config, tenantid, acc)
+            except Exception:
+                LOG.exception("[sync] cannot sync account %s", acc["iban"])
+    return missed
+
+def sync_account(config, tenantid, acc):
+    """ Queue the payments of an account newer than its high-water mark that
+        were not received, returns their number """
+    statekind = tenant.kind("sync_state", tenantid)
+    state = storage.get_value(statekind, acc["iban"])
+    endpoint = "v1/user/{}/monetary-account/{}/payment"\
+               .format(config["user_id"], acc["id"])
+    if state is None:
+        result = bunq.get(endpoint + "?count=1", config)
+        payments = [res["Payment"] for res in result["Response"]
+                    if "Payment" in res]
+        storage.store_large(statekind, acc["iban"], {
+            "last_id": payments[0]["id"] if payments else 0})
+        return 0
+
+    eventkind = tenant.kind("event_mutation", tenantid)
+    endpoint += "?count={}&newer_id={}".format(PAGE_SIZE, state["last_id"])
+    missed = 0
+    for _ in range(MAX_PAGES):
+        result = bunq.get(endpoint, config)
+        payments = sorted([res["Payment"] for res in result["Response"]
+                           if "Payment" in res], key=lambda p: p["id"])
+        if not payments:
+            break
+        events = storage.retrieve_multi(eventkind,
+                                        [p["id"] for p in payments])
+        for payment, stored in zip(payments, events):
+            if stored is None:
+                LOG.info("[sync] queueing missed payment %s", payment["id"])
+                ingest.enqueue("mutation", {"NotificationUrl": {
+                    "event_type": "MUTATION_CREATED",
+                    "object": {"Payment": payment}}})
+                missed += 1
+        state["last_id"] = payments[-1]["id"]
+        storage.store_large(statekind, acc["iban"], state)
+        pagination = result.get("Pagination") or {}
+        if not pagination.get("newer_url"):
+            break
+        endpoint = pagination["newer_url"].lstrip("/")
+    return missed
@@ -10,24 +10,28 @@ import uuid
 from flask import request
 
 import bunq
+import log
 import payment
+import util
+
+LOG = log.get_logger("targetbalance")
 
 
 def target_balance_internal():
     """ Execute a target balance internal action """
     data = request.get_json()
-    print("[target_balance_internal] input: {}".format(json.dumps(data)))
+    log.payload(LOG, "[target_balance_internal] input", data)
 
     if "actionFields" not in data:
         errmsg = "missing actionFields"
-        print("[target_balance_internal] ERROR: "+errmsg)
+        LOG.error("[target_balance_internal] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
     fields = data["actionFields"]
     errmsg = check_fields(True, fields)
     if errmsg:
-        print("[target_balance_internal] ERROR: "+errmsg)
+        LOG.error("[target_balance_internal] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -36,7 +40,7 @@ def target_balance_internal():
         return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
 
     # retrieve balance
-    config = bunq.retrieve_config()
+    config = util.get_ifttt_config()
     if fields["payment_type"] == "DIRECT":
         balance = get_balance(config, fields["account"],
                               fields["other_account"])
@@ -52,14 +56,14 @@ def target_balance_internal():
 
     if isinstance(balance, str):
         errmsg = balance
-        print("[target_balance_internal] ERROR: "+errmsg)
+        LOG.error("[target_balance_internal] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
     # construct payment message
     if "{:.2f}".format(fields["amount"]) == "0.00":
         errmsg = "No transfer needed, balance already ok"
-        print("[target_balance_internal] ERROR: "+errmsg)
+        LOG.error("[target_balance_internal] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -93,11 +97,11 @@ def target_balance_internal():
         account = fields["account"]
     else:
         errmsg = "No transfer needed, balance already ok"
-        print("[target_balance_internal] ERROR: "+errmsg)
+        LOG.error("[target_balance_internal] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
-    print(paymentmsg)
+    log.payload(LOG, "[target_balance_internal] payment", paymentmsg)
 
     # get id and check permissions
     if fields["payment_type"] == "DIRECT":
@@ -112,20 +116,24 @@ def target_balance_internal():
         errmsg = "Payment type not enabled for account: "+account
 
     if errmsg:
-        print("[target_balance_internal] ERROR: "+errmsg)
+        LOG.error("[target_balance_internal] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
     # execute the payment
     if fields["payment_type"] == "DIRECT":
         result = bunq.post("v1/user/{}/monetary-account/{}/payment"
-                           .format(config["user_id"], accid), paymentmsg)
+                           .format(config["user_id"], accid), paymentmsg,
+                           config)
     else:
         paymentmsg = {"number_of_required_accepts": 1, "entries": [paymentmsg]}
         result = bunq.post("v1/user/{}/monetary-account/{}/draft-payment"
-                           .format(config["user_id"], accid), paymentmsg)
-    print(result)
+                           .format(config["user_id"], accid), paymentmsg,
+                           config)
+    log.payload(LOG, "[target_balance_internal] result", result)
     if "Error" in result:
+        LOG.warning("[target_balance_internal] bunq error: %s",
+                    log.Json(result))
         return json.dumps({"errors": [{
             "status": "SKIP",
             "message": result["Error"][0]["error_description"]
@@ -138,18 +146,18 @@ def target_balance_internal():
 def target_balance_external():
     """ Execute a target balance external action """
     data = request.get_json()
-    print("[target_balance_external] input: {}".format(json.dumps(data)))
+    log.payload(LOG, "[target_balance_external] input", data)
 
     if "actionFields" not in data:
         errmsg = "missing actionFields"
-        print("[target_balance_external] ERROR: "+errmsg)
+        LOG.error("[target_balance_external] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
     fields = data["actionFields"]
     errmsg = check_fields(False, fields)
     if errmsg:
-        print("[target_balance_external] ERROR: "+errmsg)
+        LOG.error("[target_balance_external] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -158,11 +166,11 @@ def target_balance_external():
         return json.dumps({"data": [{"id": uuid.uuid4().hex}]})
 
     # retrieve balance
-    config = bunq.retrieve_config()
+    config = util.get_ifttt_config()
     balance = get_balance(config, fields["account"])
     if isinstance(balance, str):
         errmsg = balance
-        print("[target_balance_external] ERROR: "+errmsg)
+        LOG.error("[target_balance_external] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -171,7 +179,7 @@ def target_balance_external():
     # check for zero transfer
     if "{:.2f}".format(fields["amount"]) == "0.00":
         errmsg = "No transfer needed, balance already ok"
-        print("[target_balance_external] ERROR: "+errmsg)
+        LOG.error("[target_balance_external] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -199,7 +207,7 @@ def target_balance_external():
         errmsg = "Not permitted for account: "+fields["account"]
 
     if errmsg:
-        print("[target_balance_external] ERROR: "+errmsg)
+        LOG.error("[target_balance_external] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                , 400
 
@@ -215,7 +223,7 @@ def target_balance_external():
             bmtype = "IBAN"
         else:
             errmsg = "Unrecognized as email, phone or iban: "+bmvalue
-            print("[request_inquiry] ERROR: "+errmsg)
+            LOG.error("[request_inquiry] %s", errmsg)
             return json.dumps({"errors": [{"status": "SKIP", "message":\
                    errmsg}]}), 400
 
@@ -232,9 +240,8 @@ def target_balance_external():
             "description": fields["request_description"],
             "allow_bunqme": True,
         }
-        print(json.dumps(msg))
+        log.payload(LOG, "[target_balance_external] request", msg)
 
-        config = bunq.retrieve_config()
         result = bunq.post("v1/user/{}/monetary-account/{}/request-inquiry"\
                            .format(config["user_id"], accid), msg, config)
 
@@ -251,19 +258,22 @@ def target_balance_external():
             },
             "description": fields["payment_description"]
         }
-        print(paymentmsg)
+        log.payload(LOG, "[target_balance_external] payment", paymentmsg)
         paymentmsg = {"number_of_required_accepts": 1, "entries": [paymentmsg]}
         result = bunq.post("v1/user/{}/monetary-account/{}/draft-payment"
-                           .format(config["user_id"], accid), paymentmsg)
+                           .format(config["user_id"], accid), paymentmsg,
+                           config)
 
     else:
         errmsg = "No transfer needed, balance already ok"
-        print("[target_balance_external] ERROR: "+errmsg)
+        LOG.error("[target_balance_external] %s", errmsg)
         return json.dumps({"errors": [{"status": "SKIP", "message": errmsg}]})\
                 , 400
 
-    print(result)
+    log.payload(LOG, "[target_balance_external] result", result)
     if "Error" in result:
+        LOG.warning("[target_balance_external] bunq error: %s",
+                    log.Json(result))
         return json.dumps({"errors": [{
             "status": "SKIP",
             "message": result["Error"][0]["error_description"]
@@ -0,0 +1,101 @@
+"""
+Tenants
+
+Allows one installation to serve multiple bunq users (tenants):
+- the default tenant uses the original storage layout, so existing
+  installations keep working without any migration
+- additional tenants are keyed by their bunq user id, and their credentials
+  and triggers are stored in separate namespaces
+- callbacks are routed to a tenant by the bunq user id or the account in the
+  callback payload
+- every tenant connects its own IFTTT service, and IFTTT calls are routed to
+  a tenant by their service key
+"""
+# pylint: disable=global-statement
+
+import threading
+import time
+
+import storage
+
+# In-memory cache of the tenant registry, maps iban -> tenant
+_IBANS = None
+_IBANS_LOADED = 0
+_IBANS_REFRESH = 60
+_LOCK = threading.Lock()
+
+
+def kind(kindname, tenant=None):
+    """ Return the storage kind for the given tenant """
+    if tenant is None:
+        return kindname
+    return "{}_{}".format(tenant, kindname)
+
+def config_index(tenant=None):
+    """ Return the storage index of the bunq config for the given tenant """
+    if tenant is None:
+        return "bunq_config"
+    return "bunq_config_{}".format(tenant)
+
+
+def oauth_index(tenant=None):
+    """ Return the storage index of the bunq OAuth data for the given
+        tenant """
+    if tenant is None:
+        return "bunq_oauth"
+    return "bunq_oauth_{}".format(tenant)
+
+def ifttt_key_index(tenant=None):
+    """ Return the storage index of the IFTTT service key for the given
+        tenant """
+    if tenant is None:
+        return "ifttt_service_key"
+    return "ifttt_service_key_{}".format(tenant)
+
+
+def get_tenants():
+    """ Return the registry of additional tenants: user id -> list of ibans """
+    tenants = storage.get_value("bunq2IFTTT", "tenants")
+    if tenants is None:
+        tenants = {}
+    return tenants
+
+def all_tenants():
+    """ Return all tenants, including the default tenant (None) """
+    return [None] + sorted(get_tenants().keys())
+
+def register(tenant, ibans):
+    """ Register (or update) an additional tenant with its accounts """
+    global _IBANS
+    with _LOCK:
+        tenants = get_tenants()
+        tenants[str(tenant)] = list(ibans)
+        storage.store_large("bunq2IFTTT", "tenants", tenants)
+        _IBANS = None
+
+
+def _registry(iban=None):
+    """ Return the cached iban -> tenant registry, refreshed when needed """
+    global _IBANS, _IBANS_LOADED
+    with _LOCK:
+        # Unknown accounts may belong to a tenant registered on another
+        # instance, so refresh the cache on a miss (rate limited)
+        if _IBANS is None or (iban is not None and iban not in _IBANS and
+                              time.time() - _IBANS_LOADED > _IBANS_REFRESH):
+            ibans = {}
+            for tenant, accounts in get_tenants().items():
+                for acc in accounts:
+                    ibans[acc] = tenant
+            _IBANS = ibans
+            _IBANS_LOADED = time.time()
+        return _IBANS
+
+def for_iban(iban):
+    """ Return the tenant owning the given account, None for the default """
+    return _registry(iban).get(iban)
+
+def for_callback(obj):
+    """ Return the tenant for a bunq callback object """
+    if "user_id" in obj and str(obj["user_id"]) in _registry().values():
+        return str(obj["user_id"])
+    return for_iban(obj["alias"]["iban"])
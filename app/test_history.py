@@ -0,0 +1,59 @@
+"""
+Tests of the trigger histories, on local storage in a temporary directory
+
+Run from the app directory with: python -m unittest test_history
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+import history
+
+
+class HistoryTest(unittest.TestCase):
+    """ Reading pages of the history of a trigger """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.start = int(time.time()) - 100
+        for identity in ["aaa", "bbb"]:
+            for num in range(3):
+                history.add("mutation", None, identity, {"meta": {
+                    "id": "{}{}".format(identity, num),
+                    "timestamp": self.start + num}})
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def read_ids(self, identity, limit, **kwargs):
+        """ Return the event ids of a page of the history """
+        return [history.event_id(name) for name in history.read(
+            "mutation", None, identity, limit, **kwargs)]
+
+    def test_newest_first(self):
+        self.assertEqual(self.read_ids("bbb", 10), ["bbb2", "bbb1", "bbb0"])
+
+    def test_pages(self):
+        first = history.read("mutation", None, "bbb", 2)
+        self.assertEqual(self.read_ids("bbb", 2, cursor=first[-1]), ["bbb0"])
+
+    def test_since(self):
+        self.assertEqual(self.read_ids("bbb", 10, since=self.start),
+                         ["bbb2", "bbb1"])
+
+    def test_cursor_of_other_trigger(self):
+        other = history.read("mutation", None, "aaa", 1)[0]
+        self.assertFalse(history.valid_cursor("bbb", other))
+        with self.assertRaises(ValueError):
+            history.read("mutation", None, "bbb", 10, cursor=other)
+        with self.assertRaises(ValueError):
+            history.read("mutation", None, "bbb", 10, cursor="a")
+
+
+if __name__ == "__main__":
+    unittest.main()
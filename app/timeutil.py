@@ -0,0 +1,56 @@
+"""
+Time handling
+
+Events are stored with the integer epoch of their creation (meta.timestamp)
+and their creation time pre-rendered as an ISO string in UTC (created_at).
+Polls render the creation time in the timezone of the user, with the
+timezone looked up once and then cached. Only parsing of unusual formats
+and the timezone lookup itself use the arrow package.
+"""
+# pylint: disable=import-outside-toplevel
+
+import calendar
+import datetime
+import functools
+
+UTC = datetime.timezone.utc
+
+
+def parse(value):
+    """ Parse a bunq or ISO timestamp, timestamps without offset are UTC """
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        import arrow
+        return arrow.get(value).datetime
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=UTC)
+    return moment
+
+def epoch(moment):
+    """ Return the integer epoch of a datetime """
+    return calendar.timegm(moment.utctimetuple())
+
+def utc_iso(moment):
+    """ Return a datetime as an ISO string in UTC """
+    return moment.astimezone(UTC).isoformat()
+
+@functools.lru_cache(maxsize=100)
+def get_zone(name):
+    """ Return the tzinfo of a timezone name as accepted by arrow """
+    if name == "UTC":
+        return UTC
+    from arrow.parser import TzinfoParser
+    return TzinfoParser.parse(name)
+
+def to_zone(value, name):
+    """ Render a stored timestamp as an ISO string in the given timezone """
+    zone = get_zone(name)
+    if zone is UTC and value.endswith("+00:00"):
+        return value # pre-rendered
+    return parse(value).astimezone(zone).isoformat()
+
+def from_epoch(timestamp, name):
+    """ Render an epoch as an ISO string in the given timezone """
+    return datetime.datetime.fromtimestamp(timestamp, get_zone(name))\
+           .isoformat()
@@ -0,0 +1,198 @@
+"""
+Trigger index
+
+Keeps the triggers of each account in memory, indexed so that an event only
+visits the triggers that can possibly match it:
+- triggers are bucketed by the mutation type prefixes they accept
+- triggers with a range condition (above/below) on the amount or balance are
+  kept in lists sorted by threshold, and are selected by bisection
+- for large trigger sets, the numeric conditions are evaluated in one
+  vectorized pass when NumPy is available (see the numtable module)
+
+Triggers with identical fields (e.g. several applets for "any mutation on
+account X") share one entry, so each distinct rule is evaluated once per event
+and the result applies to all trigger identities of the group.
+
+The cached indexes are validated against a version token per tenant and
+trigger kind, which is changed whenever a trigger is stored or removed. Each
+token is a record of its own, so changes to different kinds at the same
+time cannot overwrite each other. An event then costs one small batch read
+instead of a query per account and trigger kind. When an index is replaced,
+the outdated indexes of the tenant are dropped and the multimatch targets
+are rebuilt from the predicates of the remaining indexes.
+"""
+
+import bisect
+import threading
+import uuid
+
+import multimatch
+import numtable
+import predicate
+import storage
+import tenant
+
+_INDEXES = {}
+_LOCK = threading.Lock()
+
+RANGE_FIELDS = {
+    "amount": ["amount_comparator", "amount_comparator_2"],
+    "balance": ["balance_comparator", "balance_comparator_2"],
+}
+_VALUE_FIELDS = {
+    "amount_comparator": "amount_value",
+    "amount_comparator_2": "amount_value_2",
+    "balance_comparator": "balance_value",
+    "balance_comparator_2": "balance_value_2",
+}
+
+
+def version_index(kind, tenantid=None):
+    """ Return the storage index of the version token of a trigger kind """
+    return tenant.kind("trigger_version_" + kind, tenantid)
+
+def get_versions(kinds, tenantid=None):
+    """ Return the trigger version tokens of a tenant for the given trigger
+        kinds, read in one batch """
+    records = storage.retrieve_multi("bunq2IFTTT",
+                                     [version_index(kind, tenantid)
+                                      for kind in kinds])
+    return dict([(kind, record["value"])
+                 for kind, record in zip(kinds, records)
+                 if record is not None])
+
+def changed(kind, tenantid=None):
+    """ Mark the triggers of the given kind as changed """
+    storage.store_large("bunq2IFTTT", version_index(kind, tenantid),
+                        uuid.uuid4().hex)
+
+def get_index(kind, tenantid, account, versions):
+    """ Return the index of the triggers of a kind for the given account """
+    key = (tenant.kind(kind, tenantid), account)
+    version = versions.get(kind)
+    with _LOCK:
+        entry = _INDEXES.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    index = TriggerIndex(storage.query(key[0], "account", "=", account))
+    with _LOCK:
+        _INDEXES[key] = (version, index)
+    if entry is not None:
+        refresh_targets(tenantid, versions)
+    return index
+
+def refresh_targets(tenantid, versions):
+    """ Drop the outdated indexes of a tenant, and register only the contains
+        targets of the remaining indexes """
+    current = dict([(tenant.kind(kind, tenantid), version)
+                    for kind, version in versions.items()])
+    with _LOCK:
+        for key, (version, _) in list(_INDEXES.items()):
+            if key[0] in current and version != current[key[0]]:
+                del _INDEXES[key]
+        indexes = [index for _, index in _INDEXES.values()]
+    multimatch.rebuild([target for index in indexes
+                        for _, pred in index.triggers
+                        for target in pred.targets])
+
+
+class TriggerIndex:
+    """ Index over a set of triggers, returning candidates for an event """
+
+    def __init__(self, triggers):
+        self.triggers = [] # (triggers with identical fields, predicate)
+        self.any_type = []
+        self.by_type = {}
+        self.ranges = {}
+        free = {name: [] for name in RANGE_FIELDS}
+        bounds = {name: {"above": [], "above_equal": [], "below": [],
+                         "below_equal": []} for name in RANGE_FIELDS}
+
+        groups = {}
+        for trigger in triggers:
+            key = predicate.fields_hash(trigger["fields"])
+            if key in groups:
+                groups[key].append(trigger)
+                continue
+            pred = predicate.get_predicate(trigger["fields"], key)
+            if pred.error is not None:
+                continue # never matches
+            num = len(self.triggers)
+            groups[key] = [trigger]
+            self.triggers.append((groups[key], pred))
+            if pred.types is None:
+                self.any_type.append(num)
+            else:
+                for typ in pred.types:
+                    self.by_type.setdefault(typ, []).append(num)
+            for name, comparators in RANGE_FIELDS.items():
+                bound = range_bound(trigger["fields"], comparators)
+                if bound is None:
+                    free[name].append(num)
+                elif bound[1] == bound[1]: # NaN thresholds never match
+                    bounds[name][bound[0]].append((bound[1], num))
+
+        self.any_type = frozenset(self.any_type)
+        for name in RANGE_FIELDS:
+            lists = {}
+            for comparator, entries in bounds[name].items():
+                entries.sort()
+                lists[comparator] = ([thr for thr, _ in entries],
+                                     [num for _, num in entries])
+            self.ranges[name] = (frozenset(free[name]), lists)
+
+        self.table = None
+        if numtable.available(len(self.triggers)):
+            self.table = numtable.NumericTable(
+                [group[0]["fields"] for group, _ in self.triggers])
+
+    def __len__(self):
+        return sum([len(group) for group, _ in self.triggers])
+
+    def candidates(self, item):
+        """ Return the (triggers, predicate) pairs that may match the item,
+            with the triggers that share the predicate """
+        selected = self.any_type
+        if "type" in item:
+            typ = item["type"]
+            for end in range(1, len(typ) + 1):
+                if typ[:end] in self.by_type:
+                    selected = selected.union(self.by_type[typ[:end]])
+        else:
+            selected = range(len(self.triggers))
+        if self.table is not None:
+            passed = self.table.evaluate(item).nonzero()[0]
+            return [self.triggers[num] for num in passed if num in selected]
+        for name, (free, lists) in self.ranges.items():
+            if name not in item or not selected:
+                continue
+            try:
+                value = float(item[name])
+            except ValueError:
+                continue
+            hits = range_matches(lists, value)
+            selected = free.intersection(selected).union(
+                [num for num in hits if num in selected])
+        return [self.triggers[num] for num in sorted(selected)]
+
+
+def range_bound(fields, comparators):
+    """ Return the first (comparator, threshold) range condition, if any """
+    for comp in comparators:
+        if comp in fields and fields[comp] in ["above", "above_equal",
+                                               "below", "below_equal"]:
+            return fields[comp], float(fields[_VALUE_FIELDS[comp]])
+    return None
+
+def range_matches(lists, value):
+    """ Return the triggers whose range condition holds for the value """
+    result = []
+    thrs, nums = lists["above"]
+    result.extend(nums[:bisect.bisect_left(thrs, value)])
+    thrs, nums = lists["above_equal"]
+    result.extend(nums[:bisect.bisect_right(thrs, value)])
+    thrs, nums = lists["below"]
+    result.extend(nums[bisect.bisect_right(thrs, value):])
+    thrs, nums = lists["below_equal"]
+    result.extend(nums[bisect.bisect_left(thrs, value):])
+    return result
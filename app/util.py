@@ -3,13 +3,27 @@ Utility methods
 
 Mainly to handle storage and caching of some frequently used data elements
 """
-# pylint: disable=global-statement
+# pylint: disable=global-statement,import-outside-toplevel
+
+import threading
+import time
 
 import bunq
+import log
 import storage
+import tenant
+
+LOG = log.get_logger("util")
 
 # Use global variables as in-memory cache mechanisms
 _IFTTT_SERVICE_KEY = None
+_IFTTT_TENANTS = None
+_IFTTT_TENANTS_LOADED = 0
+_IFTTT_TENANTS_REFRESH = 60
+_IFTTT_SESSION = None
+_IFTTT_LOCK = threading.Lock()
+
+IFTTT_REALTIME = "https://realtime.ifttt.com/"
 
 
 # WARNING: the follow setting is extremely dangerous to change !!!!!!!!!!!!!!!!
@@ -41,11 +55,72 @@ def get_ifttt_service_key(key=None):
             _IFTTT_SERVICE_KEY = entity["value"]
     return _IFTTT_SERVICE_KEY
 
-def save_ifttt_service_key(value):
-    """ Save the IFTTT service key, used to secure IFTTT calls """
-    global _IFTTT_SERVICE_KEY
-    _IFTTT_SERVICE_KEY = value
-    storage.store("bunq2IFTTT", "ifttt_service_key", {"value": value})
+def save_ifttt_service_key(value, tenantid=None):
+    """ Save the IFTTT service key of a tenant, used to secure IFTTT calls """
+    global _IFTTT_SERVICE_KEY, _IFTTT_TENANTS
+    if tenantid is None:
+        _IFTTT_SERVICE_KEY = value
+    _IFTTT_TENANTS = None
+    storage.store("bunq2IFTTT", tenant.ifttt_key_index(tenantid),
+                  {"value": value})
+
+def load_ifttt_tenants():
+    """ Load the IFTTT service keys of all tenants, returns key -> tenant """
+    global _IFTTT_TENANTS, _IFTTT_TENANTS_LOADED
+    tenants = {}
+    for tenantid in tenant.all_tenants():
+        entity = storage.retrieve("bunq2IFTTT",
+                                  tenant.ifttt_key_index(tenantid))
+        if entity is not None:
+            tenants[entity["value"]] = tenantid
+    _IFTTT_TENANTS = tenants
+    _IFTTT_TENANTS_LOADED = time.time()
+    return tenants
+
+def ifttt_key_tenant(key):
+    """ Return the tenant of an IFTTT service key, as (valid, tenant). Each
+        tenant connects its own IFTTT service, identified by its key. """
+    tenants = _IFTTT_TENANTS
+    # Unknown keys may have been set on another instance, so reload on a
+    # miss, rate limited so invalid keys do not cause reads on every call
+    if tenants is None or (key not in tenants and time.time() -
+                           _IFTTT_TENANTS_LOADED > _IFTTT_TENANTS_REFRESH):
+        tenants = load_ifttt_tenants()
+    return key in tenants, tenants.get(key)
+
+def get_ifttt_tenant_key(tenantid):
+    """ Return the IFTTT service key of a tenant """
+    if tenantid is None:
+        return get_ifttt_service_key()
+    tenants = _IFTTT_TENANTS
+    if tenants is None:
+        tenants = load_ifttt_tenants()
+    for key, keytenant in tenants.items():
+        if keytenant == tenantid:
+            return key
+    return None
+
+def ifttt_tenant():
+    """ Return the tenant of the IFTTT service making the current request """
+    from flask import request
+    return ifttt_key_tenant(request.headers.get("IFTTT-Service-Key"))[1]
+
+def get_ifttt_config():
+    """ Return the bunq config of the tenant of the current IFTTT request """
+    return bunq.retrieve_config(tenantid=ifttt_tenant())
+
+def get_config_for_account(iban):
+    """ Return the bunq config of the tenant owning the given account """
+    return bunq.retrieve_config(tenantid=tenant.for_iban(iban))
+
+def get_ifttt_session():
+    """ Return the HTTP session (connection pool) used for calls to IFTTT """
+    global _IFTTT_SESSION
+    with _IFTTT_LOCK:
+        if _IFTTT_SESSION is None:
+            import requests
+            _IFTTT_SESSION = requests.Session()
+        return _IFTTT_SESSION
 
 
 def check_valid_bunq_account(iban, permission=None, config=None):
@@ -85,11 +160,15 @@ def get_bunq_accounts_with_permissions(config):
     return results
 
 def update_bunq_accounts():
-    """ Update the list of bunq accounts """
-    config = bunq.retrieve_config()
-    bunq.retrieve_accounts(config)
-    sync_permissions(config)
-    bunq.save_config(config)
+    """ Update the list of bunq accounts for all tenants """
+    for tenantid in tenant.all_tenants():
+        config = bunq.retrieve_config(tenantid=tenantid)
+        bunq.retrieve_accounts(config)
+        sync_permissions(config)
+        bunq.save_config(config)
+        if tenantid is not None:
+            tenant.register(tenantid,
+                            [acc["iban"] for acc in config["accounts"]])
 
 def sync_permissions(config):
     """ Synchronize permissions between the old and new account lists """
@@ -138,15 +217,15 @@ def account_change_permission(iban, permission, value):
     """ Change a permission on an account """
     if permission not in ["Internal", "Draft", "Mutation", "Request", "Card"] \
     and not (permission == "External" and get_external_payment_enabled()):
-        print("Invalid permission: "+permission)
+        LOG.warning("[util] invalid permission: %s", permission)
         return False
 
     if value not in ["true", "false"]:
-        print("Invalid value: "+value)
+        LOG.warning("[util] invalid permission value: %s", value)
         return False
     value = (value == "true")
 
-    config = bunq.retrieve_config()
+    config = get_config_for_account(iban)
     if "permissions" not in config:
         config["permissions"] = {}
 
@@ -0,0 +1,39 @@
+"""
+Warmup
+
+Prepares a new instance before it takes traffic, so the first real callback
+does not pay for creating the datastore client, parsing the bunq keys and
+setting up connections. The bunq configuration itself is not kept: it is
+read from storage on every request, as other instances may change it (e.g.
+a refreshed session token). Called by the App Engine warmup request, or on
+startup when running standalone.
+"""
+# pylint: disable=broad-except
+
+import time
+
+import bunq
+import event
+import log
+import tenant
+import util
+
+LOG = log.get_logger("warmup")
+
+
+def warmup():
+    """ Fill the in-memory caches and open connections """
+    start = time.time()
+    try:
+        util.get_ifttt_service_key()
+        util.load_ifttt_tenants()
+        for tenantid in tenant.all_tenants():
+            # Only for the parsed keys, which the bunq module caches
+            bunq.retrieve_config(tenantid=tenantid)
+            bunq.warmup_session(tenantid)
+        triggers = event.preload_triggers()
+        util.get_ifttt_session().head(util.IFTTT_REALTIME, timeout=5)
+        LOG.info("[warmup] completed in %.0f ms, %d ANY triggers",
+                 (time.time() - start) * 1000, triggers)
+    except Exception:
+        LOG.exception("[warmup] error during warmup")